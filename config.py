@@ -43,6 +43,48 @@ class Config(object):
 
     BATCH_CHUNK_SIZE = 100
 
+    # When getting streams for a query, activity summaries are looked up
+    #  in the cache in chunks of BATCH_CHUNK_SIZE, or whatever we have
+    #  after waiting this long (seconds) for a chunk to fill up.
+    BATCH_CHUNK_TIMEOUT = 0.05
+
+    # Websocket clients that ask for it get messages batched into frames
+    #  of up to WS_BATCH_BYTES, sent at most WS_BATCH_INTERVAL seconds
+    #  after the first message in them.  Clients that ask for deflate
+    #  get frames of WS_DEFLATE_MIN_BYTES or more zlib-compressed.
+    WS_BATCH_BYTES = 64 * 1024
+    WS_BATCH_INTERVAL = 0.05
+    WS_DEFLATE_MIN_BYTES = 1024
+
+    # Clients that use flow control grant us credit (in bytes) as they
+    #  take in what we send them.  If we have no credit for this long
+    #  we give up on the client.
+    WS_CREDIT_TIMEOUT = 60
+
+    # A websocket query can be resumed (after the connection drops) for
+    #  this long after the last activity we sent for it
+    TTL_QUERY_CURSOR = 10 * 60
+
+    # While importing a user's index we write it to MongoDB in batches
+    #  of this many entries (or bytes) as pages come in.  If this many
+    #  batches are waiting to be written, the import waits.
+    INDEX_WRITE_BATCH_SIZE = 500
+    INDEX_WRITE_BATCH_BYTES = 1024 * 1024
+    INDEX_WRITE_MAX_PENDING = 4
+
+    # CPU-heavy work (stream encoding, JSON decoding, tile rendering) runs
+    #  on this many native threads per worker, so it doesn't block the
+    #  event loop.  0 means run it inline.  Calls that queue up while the
+    #  threads are busy are handed over up to CPU_POOL_BATCH_SIZE at a time.
+    CPU_POOL_THREADS = int(os.environ.get("CPU_POOL_THREADS", 2))
+    CPU_POOL_BATCH_SIZE = 16
+
+    # We check how long the event loop is blocked by waking up every
+    #  LOOP_MONITOR_INTERVAL seconds.  Wake-ups later than
+    #  LOOP_MONITOR_THRESHOLD seconds count as blocks (see /app/info)
+    LOOP_MONITOR_INTERVAL = 0.1
+    LOOP_MONITOR_THRESHOLD = 0.05
+
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {
         "pool_pre_ping": True,
@@ -68,12 +110,52 @@ class Config(object):
     # How long we store Index entry in MongoDB
     TTL_INDEX = int(os.environ.get("TTL_INDEX", 10)) * SECS_IN_DAY
 
+    # A user's index is updated with any activities newer than the newest
+    #  one it already has, at most this often (seconds).  The whole index
+    #  is rebuilt from scratch (to pick up edits and deletions we may have
+    #  missed) only on request or once it is this old.  Set to 0 to
+    #  never rebuild on a schedule.
+    INDEX_REFRESH_INTERVAL = int(os.environ.get("INDEX_REFRESH_MINUTES", 10)) * 60
+    INDEX_REBUILD_INTERVAL = int(os.environ.get("INDEX_REBUILD_DAYS", 30)) * SECS_IN_DAY
+
     # How long we store Activity stream data in MongoDB
     TTL_DB = int(os.environ.get("TTL_DB", 4)) * SECS_IN_DAY
 
+    # Refreshing the TTL ("ts") of index entries and stream records when
+    #  they are read is deferred: touched ids are collected and written
+    #  together every TTL_TOUCH_INTERVAL seconds, and ids that were
+    #  refreshed less than TTL_TOUCH_MIN_AGE seconds ago are skipped.
+    TTL_TOUCH_INTERVAL = 60
+    TTL_TOUCH_MIN_AGE = 1 * SECS_IN_HOUR
+
+    # Per-user activity stats (counts, totals, date span, bounds) are
+    #  kept up to date as activities are indexed, but are recomputed
+    #  from the index if they are older than this, since index entries
+    #  also expire on their own.
+    USER_STATS_MAX_AGE = 1 * SECS_IN_DAY
+
+    # How long we Redis-cache rendered heatmap tiles
+    TTL_TILES = 1 * SECS_IN_DAY
+
     # How long we Redis-cache Activity stream data
     TTL_CACHE = int(os.environ.get("TTL_CACHE", 4)) * SECS_IN_HOUR
 
+    # Size (in bytes) of the in-process (per-worker) cache of activity
+    #  stream data that sits in front of Redis.  Set to 0 to disable.
+    MEMORY_CACHE_SIZE = int(os.environ.get("MEMORY_CACHE_MB", 64)) * 1024 * 1024
+
+    # A worker that changes or deletes an activity's streams publishes
+    #  its id to the other workers on this Redis channel, so they drop
+    #  their copies.  A worker can miss a message (while its
+    #  subscription is reconnecting), so in-process entries also expire
+    #  after MEMORY_CACHE_TTL seconds, which bounds how long one can
+    #  be stale.
+    ACTIVITIES_CHANNEL = "activities"
+    MEMORY_CACHE_TTL = 10 * 60
+
+    # Number of activity ids we look up in the Redis cache at once
+    CACHE_CHUNK_SIZE = 50
+
     CACHE_IP_INFO_TIMEOUT = 1 * SECS_IN_DAY # 1 day
 
     JSONIFY_PRETTYPRINT_REGULAR = True
@@ -90,6 +172,20 @@ class Config(object):
     # Maximum size of event history (for capped MongoDB collection)
     MAX_HISTORY_BYTES = 2 * 1024 * 1024  # 2MB
 
+    # New events are published to this Redis channel for live updates.
+    #  Each subscriber (admin websocket) has a buffer of this many events,
+    #  and if it can't keep up we drop the oldest.
+    EVENTS_CHANNEL = "events"
+    EVENTS_BUFFER_SIZE = 100
+
+    # Logged events are written to MongoDB in batches, when there are
+    #  EVENTS_FLUSH_SIZE of them or EVENTS_FLUSH_INTERVAL seconds after
+    #  the first one.  If more than EVENTS_MAX_PENDING are waiting to be
+    #  written (MongoDB is down or slow) we drop new ones.
+    EVENTS_FLUSH_SIZE = 100
+    EVENTS_FLUSH_INTERVAL = 2
+    EVENTS_MAX_PENDING = 5000
+
     # Paypal Stuff
     # PAYPAL_VERIFY_URL = 'https://ipnpb.paypal.com/cgi-bin/webscr'
     PAYPAL_VERIFY_URL = 'https://ipnpb.sandbox.paypal.com/cgi-bin/webscr'
@@ -103,6 +199,39 @@ class Config(object):
 
     STREAMS_TO_IMPORT = ["latlng", "time"]
 
+    # Strava API.  STRAVA_API_URL can point to a local stub server
+    #  (see testing/strava_stub.py) for benchmarking.
+    STRAVA_API_URL = os.environ.get(
+        "STRAVA_API_URL", "https://www.strava.com/api/v3"
+    )
+
+    # Ask Strava for gzip-compressed responses
+    STRAVA_GZIP = True
+
+    # Strava API rate limits (requests per 15 minutes, per day).  These are
+    #  just the starting values. Strava tells us the actual limits and our
+    #  current usage in the headers of every response.
+    STRAVA_RATE_LIMITS = (600, 30000)
+
+    # We pace requests so as to use at most this fraction of each limit,
+    #  and keep this fraction of the 15-minute limit for interactive
+    #  (user-facing) requests only.
+    STRAVA_RATE_LIMIT_SAFETY = 0.9
+    STRAVA_RATE_LIMIT_RESERVE = 0.2
+
+    # Keep the rate limiter's token bucket and request counts in Redis so
+    #  that all workers share one budget
+    STRAVA_RATE_LIMIT_REDIS = bool(os.environ.get("STRAVA_RATE_LIMIT_REDIS"))
+
+    # Interactive (user-facing) requests wait at most this many seconds
+    #  for the rate limiter, and get a 429 (rate limited) response
+    #  instead of waiting any longer
+    STRAVA_RATE_LIMIT_MAX_WAIT = 2
+
+    # How many times we retry a request that got a 429 (rate limited)
+    #  response, backing off in between
+    STRAVA_MAX_RETRIES = 3
+
     # The number of failed stream import requests we will allow before
     #  aborting an import.
     MAX_IMPORT_ERRORS = 100
@@ -128,7 +257,9 @@ class Config(object):
         c2=(["c2"], 0),
         sz=(["sz"], 0),
         paused=(["paused", "p"], 0),
-        shadows=(["sh", "shadows"], None)
+        shadows=(["sh", "shadows"], None),
+        bbox=(["bbox"], None),
+        lod=(["lod"], None)
     )
 
     # A few Demos
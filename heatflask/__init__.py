@@ -62,7 +62,8 @@ def create_app():
         #     content_security_policy=app.config["CONTENT_SECURITY_POLICY"]
         # )
         from .models import (
-            Activities, EventLogger, Index, Payments
+            Activities, EventLogger, Index, Payments, UserStats,
+            loop_monitor
         )
 
         import heatflask.routes
@@ -84,6 +85,13 @@ def create_app():
             Index.init_db()
         else:
             Index.update_ttl()
+            Index.ensure_indexes()
+        Index.check_query_plans()
+
+        if UserStats.name not in collections:
+            UserStats.init_db()
+
+        loop_monitor.start()
 
         if Payments.name not in collections:
             Payments.init_db()
@@ -725,6 +725,9 @@ function heatflask() {
 
     let sock;
 
+    // How many bytes the server may send us before we have handled them
+    const WS_CREDIT_WINDOW = 1024 * 1024;
+
     window.addEventListener('beforeunload', function (event) {
         if (navigator.sendBeacon) {
             if (appState.wskey) {
@@ -759,11 +762,15 @@ function heatflask() {
         let rendering = true,
             listening = true,
             numActivities = 0,
-            count = 0;
+            count = 0,
+            cursor = null;
 
         if (!sock || sock.readyState > 1) {
             sock = new PersistentWebSocket(WEBSOCKET_URL);
             sock.binaryType = 'arraybuffer';
+            // framing options the server has agreed to
+            sock.options = {};
+            sock.received = Promise.resolve();
         } else
             sendQuery();
 
@@ -817,6 +824,32 @@ function heatflask() {
         }
 
 
+        // The ids we already have, in ascending order, each as its
+        //  difference from the previous one, written as base64-encoded
+        //  LEB128 varints (see id_digest_decode in codecs.py).  This is
+        //  much shorter than the list of ids itself.  Ids are bigger
+        //  than 32 bits, so we can't use bitwise operators on them.
+        function idDigest(ids) {
+            const sorted = ids.slice().sort((a, b) => a - b);
+            let bytes = "";
+            sorted.forEach((id, i) => {
+                let d = i? id - sorted[i-1] : id;
+                while (d >= 128) {
+                    bytes += String.fromCharCode(128 + d % 128);
+                    d = Math.floor(d / 128);
+                }
+                bytes += String.fromCharCode(d);
+            });
+            return btoa(bytes);
+        }
+
+        // The part of the map we are looking at, so that the server
+        //  can send us visible activities first
+        function viewport() {
+            const b = map.getBounds();
+            return [[b.getSouth(), b.getWest()], [b.getNorth(), b.getEast()]];
+        }
+
         function sendQuery() {
             const queryObj = {
                 client_id: ONLOAD_PARAMS.client_id
@@ -827,16 +860,78 @@ function heatflask() {
                     after: date1? date1 : undefined,
                     before: (date2 && date2 != "now")? date2 : undefined,
                     activity_ids: idString?  Array.from(new Set(idString.split(/\D/).map(Number))): undefined,
-                    exclude_ids: to_exclude.length?  to_exclude: undefined,
+                    exclude_digest: to_exclude.length?  idDigest(to_exclude): undefined,
+                    viewport: Dom.prop("#autozoom", "checked")? undefined : viewport(),
+                    bbox: ONLOAD_PARAMS.bbox || undefined,
+                    zoom: ONLOAD_PARAMS.lod? map.getZoom() : undefined,
                     streams: true
             };
 
-            let msg = JSON.stringify({query: queryObj});
-            sock.send(msg);
+            const msgObj = {
+                query: queryObj,
+                options: wsOptions(),
+                resumable: true
+            };
+
+            // If we lost the connection part way through this query,
+            //  ask the server to send us the rest of it.  It may have
+            //  sent things we didn't get, so we tell it what we have.
+            if (cursor) {
+                const have = Array.from(appState.items.keys()).map(Number);
+                msgObj.resume = {cursor: cursor, have: idDigest(have)};
+                // the server will count what is left
+                numActivities = count;
+            }
+
+            sock.send(JSON.stringify(msgObj));
+        }
+
+        // Ask the server to batch messages into fewer frames, and to
+        //  compress them if we can decompress them.  With credit, the
+        //  server only sends that many bytes ahead of what we have
+        //  handled (see grantCredit).
+        function wsOptions() {
+            sock.unacked = 0;
+            return {
+                batch: true,
+                deflate: typeof DecompressionStream !== "undefined",
+                credit: WS_CREDIT_WINDOW
+            };
+        }
+
+        // Tell the server we have handled another nbytes, once we have
+        //  handled half of our window since we last told it.
+        function grantCredit(nbytes) {
+            if (!sock.options.credit)
+                return;
+            sock.unacked += nbytes;
+            if (sock.unacked >= WS_CREDIT_WINDOW / 2 && sock.readyState == 1) {
+                sock.send(JSON.stringify({credit: sock.unacked}));
+                sock.unacked = 0;
+            }
+        }
+
+        async function inflate(bytes) {
+            const stream = new Blob([bytes]).stream()
+                .pipeThrough(new DecompressionStream("deflate"));
+            return new Uint8Array(await new Response(stream).arrayBuffer());
+        }
+
+        async function decodeFrame(data) {
+            let bytes = new Uint8Array(data);
+            if (sock.options.deflate) {
+                const compressed = bytes[0] === 1;
+                bytes = bytes.subarray(1);
+                if (compressed)
+                    bytes = await inflate(bytes);
+            }
+            return msgpack.decode(bytes);
         }
 
         sock.onopen = function(event) {
             // console.log("socket open: ", event);
+            // a new connection starts with the default framing
+            sock.options = {};
             if (rendering) sendQuery();
         }
 
@@ -844,22 +939,32 @@ function heatflask() {
             // console.log(`socket ${appState.wskey} closed:`, event);
         }
 
-        // handle one incoming chunk from websocket stream
+        // handle one incoming frame from websocket stream.  Frames may
+        //  need decompressing, which is asynchronous, so we handle them
+        //  in a chain to keep them in order.
         sock.onmessage = function(event) {
+            sock.received = sock.received
+                .then(() => decodeFrame(event.data))
+                .then(A => {
+                    // a batch of messages comes as an array
+                    if (Array.isArray(A))
+                        A.forEach(handleMessage);
+                    else
+                        handleMessage(A);
+                })
+                .catch(e => {
+                    console.log(event);
+                    console.log(event.data);
+                    console.log(e);
+                })
+                .then(() => grantCredit(event.data.byteLength));
+        }
 
-            let A;
-
-            try {
-                A = msgpack.decode(new Uint8Array(event.data));
-            }
-            catch(e) {
-                console.log(event);
-                console.log(event.data);
-                console.log(e);
-                return;
-            }
+        // handle one message
+        function handleMessage(A) {
 
             if (!A) {
+                cursor = null;
                 Dom.prop('#renderButton', 'disabled', false);
                 doneRendering("Finished.");
                 return;
@@ -876,6 +981,12 @@ function heatflask() {
                 else if ("wskey" in A)
                     appState.wskey = A.wskey;
 
+                else if ("options" in A)
+                    sock.options = A.options;
+
+                else if ("cursor" in A)
+                    cursor = A.cursor;
+
                 else if ("delete" in A && A.delete.length) {
                     // delete all ids in A.delete
                     for (let id of A.delete)
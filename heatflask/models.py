@@ -1,20 +1,31 @@
 # Standard library imports
 import json
+import zlib
+import os
 import uuid
+import atexit
 import time
+import heapq
+import random
+import itertools
 from bson import ObjectId
 from operator import truth
 from bson.binary import Binary
 from contextlib import contextmanager
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from itertools import islice, repeat, starmap, takewhile
 
 # Third party imports
 import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
+import gevent.queue
 import msgpack
 import pymongo
+import bson
 import requests
-import polyline
 import stravalib
 import dateutil
 import dateutil.parser
@@ -23,11 +34,15 @@ from flask import current_app as app
 from flask_login import UserMixin
 from geventwebsocket import WebSocketError
 from sqlalchemy.dialects import postgresql as pg
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
 # Local application imports
 from . import mongo, db_sql, redis  # Global database clients
 from . import EPOCH
+from . import codecs
+from . import tiles
+from . import offload
 
 mongodb = mongo.db
 log = app.logger
@@ -37,13 +52,50 @@ STRAVA_CLIENT_SECRET = app.config["STRAVA_CLIENT_SECRET"]
 TRIAGE_CONCURRENCY = app.config["TRIAGE_CONCURRENCY"]
 ADMIN = app.config["ADMIN"]
 BATCH_CHUNK_SIZE = app.config["BATCH_CHUNK_SIZE"]
+BATCH_CHUNK_TIMEOUT = app.config["BATCH_CHUNK_TIMEOUT"]
+WS_BATCH_BYTES = app.config["WS_BATCH_BYTES"]
+WS_BATCH_INTERVAL = app.config["WS_BATCH_INTERVAL"]
+WS_DEFLATE_MIN_BYTES = app.config["WS_DEFLATE_MIN_BYTES"]
+WS_CREDIT_TIMEOUT = app.config["WS_CREDIT_TIMEOUT"]
+TTL_QUERY_CURSOR = app.config["TTL_QUERY_CURSOR"]
+INDEX_WRITE_BATCH_SIZE = app.config["INDEX_WRITE_BATCH_SIZE"]
+INDEX_WRITE_BATCH_BYTES = app.config["INDEX_WRITE_BATCH_BYTES"]
+INDEX_WRITE_MAX_PENDING = app.config["INDEX_WRITE_MAX_PENDING"]
+CPU_POOL_THREADS = app.config["CPU_POOL_THREADS"]
+CPU_POOL_BATCH_SIZE = app.config["CPU_POOL_BATCH_SIZE"]
+LOOP_MONITOR_INTERVAL = app.config["LOOP_MONITOR_INTERVAL"]
+LOOP_MONITOR_THRESHOLD = app.config["LOOP_MONITOR_THRESHOLD"]
 IMPORT_CONCURRENCY = app.config["IMPORT_CONCURRENCY"]
 DAYS_INACTIVE_CUTOFF = app.config["DAYS_INACTIVE_CUTOFF"]
 MAX_IMPORT_ERRORS = app.config["MAX_IMPORT_ERRORS"]
 
 TTL_INDEX = app.config["TTL_INDEX"]
+INDEX_REFRESH_INTERVAL = app.config["INDEX_REFRESH_INTERVAL"]
+INDEX_REBUILD_INTERVAL = app.config["INDEX_REBUILD_INTERVAL"]
 TTL_CACHE = app.config["TTL_CACHE"]
+MEMORY_CACHE_SIZE = app.config["MEMORY_CACHE_SIZE"]
+MEMORY_CACHE_TTL = app.config["MEMORY_CACHE_TTL"]
+ACTIVITIES_CHANNEL = app.config["ACTIVITIES_CHANNEL"]
+CACHE_CHUNK_SIZE = app.config["CACHE_CHUNK_SIZE"]
 TTL_DB = app.config["TTL_DB"]
+TTL_TILES = app.config["TTL_TILES"]
+USER_STATS_MAX_AGE = app.config["USER_STATS_MAX_AGE"]
+TTL_TOUCH_INTERVAL = app.config["TTL_TOUCH_INTERVAL"]
+TTL_TOUCH_MIN_AGE = app.config["TTL_TOUCH_MIN_AGE"]
+EVENTS_CHANNEL = app.config["EVENTS_CHANNEL"]
+EVENTS_BUFFER_SIZE = app.config["EVENTS_BUFFER_SIZE"]
+EVENTS_FLUSH_SIZE = app.config["EVENTS_FLUSH_SIZE"]
+EVENTS_FLUSH_INTERVAL = app.config["EVENTS_FLUSH_INTERVAL"]
+EVENTS_MAX_PENDING = app.config["EVENTS_MAX_PENDING"]
+
+# CPU-heavy work runs on cpu_pool threads, off the event loop, and
+#  loop_monitor keeps track of how much the event loop gets blocked
+#  anyway (see offload.py)
+cpu_pool = offload.CPUPool(CPU_POOL_THREADS, CPU_POOL_BATCH_SIZE)
+loop_monitor = offload.LoopMonitor(
+    LOOP_MONITOR_INTERVAL,
+    LOOP_MONITOR_THRESHOLD
+)
 
 
 @contextmanager
@@ -371,6 +423,23 @@ class Users(UserMixin, db_sql.Model):
     def delete_index(self):
         return Index.delete_user_entries(self)
 
+    def index_expired(self, now=None):
+        # True if it is time for a scheduled full rebuild of this
+        #  user's index
+        if not (INDEX_REBUILD_INTERVAL and self.dt_indexed):
+            return False
+        now = now or datetime.utcnow()
+        age = (now - self.dt_indexed).total_seconds()
+        return age > INDEX_REBUILD_INTERVAL
+
+    def mark_indexed(self, session=db_sql.session):
+        self.dt_indexed = datetime.utcnow()
+        try:
+            session.commit()
+        except Exception:
+            session.rollback()
+            log.exception("error updating dt_indexed for %s", self)
+
     def indexing(self, status=None):
         # return or set the current state of index building
         #  for this user
@@ -388,7 +457,10 @@ class Users(UserMixin, db_sql.Model):
             return
 
         return Index.import_user_index(
-            user=self,
+            client=StravaClient(
+                user=self,
+                priority=StravaRateLimiter.BACKGROUND
+            ),
             out_query=args,
             yielding=False
         )
@@ -396,13 +468,20 @@ class Users(UserMixin, db_sql.Model):
     def query_activities(self,
                          activity_ids=None,
                          exclude_ids=[],
+                         exclude_digest=None,
                          limit=None,
                          after=None, before=None,
                          streams=False,
                          owner_id=False,
                          update_index_ts=True,
                          cache_timeout=TTL_CACHE,
+                         viewport=None,
+                         bbox=None,
+                         zoom=None,
+                         on_sent=None,
                          **kwargs):
+        # on_sent(id) is called for each activity once the consumer
+        #  has taken it and asked for the next thing
 
         # convert date strings to datetimes, if applicable
         if before or after:
@@ -421,7 +500,8 @@ class Users(UserMixin, db_sql.Model):
             limit=limit,
             after=after,
             before=before,
-            activity_ids=activity_ids
+            activity_ids=activity_ids,
+            bbox=bbox
         ))
         # log.debug("received query %s", client_query)
 
@@ -432,7 +512,7 @@ class Users(UserMixin, db_sql.Model):
                 yield {"error": "bad StravaClient. cannot import"}
 
         # exit if this query is empty
-        if not any([limit, activity_ids, before, after]):
+        if not any([limit, activity_ids, before, after, bbox]):
             log.debug("%s empty query", self)
             return
 
@@ -440,10 +520,30 @@ class Users(UserMixin, db_sql.Model):
             yield {"idx": self.indexing()}
             gevent.sleep(0.5)
 
-        if self.index_count():
+        index_count = self.index_count()
+        if index_count and self.index_expired():
+            log.info("%s index is due for a rebuild", self)
+            self.delete_index()
+            index_count = 0
+
+        if index_count:
+            # Get anything new since we last looked (usually a single
+            #  page request) in the background, so that we don't hold
+            #  up this query waiting for Strava.  New activities show
+            #  up the next time.
+            if self.strava_client:
+                gevent.spawn(
+                    Index.refresh_user_index,
+                    StravaClient(
+                        user=self,
+                        priority=StravaRateLimiter.BACKGROUND
+                    )
+                )
+
             summaries_generator = Index.query(
                 user=self,
                 exclude_ids=exclude_ids,
+                exclude_digest=exclude_digest,
                 update_ts=update_index_ts,
                 **client_query
             )
@@ -466,6 +566,8 @@ class Users(UserMixin, db_sql.Model):
             if not summaries_generator:
                 log.info("Could not build index for %s", self)
                 return
+
+            self.mark_indexed()
         
         # Here we introduce a mapper that readys an activity summary
         #  (with or without streams) to be yielded to the client
@@ -488,6 +590,7 @@ class Users(UserMixin, db_sql.Model):
 
             ttl = (A["ts"] - now).total_seconds() + TTL_INDEX
             A["ttl"] = max(0, int(ttl))
+            A.pop("box", None)
 
             try:
                 ts_local = A.pop("ts_local")
@@ -507,19 +610,30 @@ class Users(UserMixin, db_sql.Model):
             if owner_id:
                 A.update(dict(owner=self.id, profile=self.profile))
 
+            # If this activity came with msgpack-encoded streams
+            #  we pack the summary and splice them together, so
+            #  we export bytes that are ready to send
+            packed_streams = A.pop(Activities.PACKED_STREAMS, None)
+            if packed_streams:
+                return codecs.msgpack_merge(msgpack.packb(A), packed_streams)
+
             return A
         
         # if we are only sending summaries to client,
         #  get them ready to export and yield them
         count = 0
         if not streams:
-            for A in map(export, summaries_generator):
-                if A and "_id" in A:
+            for A in summaries_generator:
+                _id = A.get("_id") if isinstance(A, dict) else None
+                A = export(A)
+                if A and _id:
                     count += 1
                 abort_signal = yield A
                 if abort_signal:
                     summaries_generator.send(abort_signal)
                     break
+                if _id and on_sent:
+                    on_sent(_id)
             log.debug(
                 "%s exported %s summaries in %s", self, count, timer.elapsed()
             )
@@ -528,10 +642,35 @@ class Users(UserMixin, db_sql.Model):
         #  summaries_generator yields activity summaries without streams
         #  We want to attach a stream to each one, get it ready to export,
         #  and yield it.
+
+        #  If the client gives us the map zoom it will be looking at,
+        #  we send the cheapest level of detail that looks right there
+        try:
+            lod = codecs.lod_for_zoom(None if zoom is None else float(zoom))
+        except ValueError:
+            lod = None
         
+        #  If the client tells us what part of the map it is showing
+        #  (viewport is [[south, west], [north, east]]) then activities
+        #  that are visible there jump ahead of the others at every
+        #  stage: cache lookup and stream import.
+        if viewport:
+            def priority(A):
+                if A is StopIteration:
+                    return 3
+                if not (isinstance(A, dict) and "_id" in A):
+                    return 0
+                visible = Utility.bounds_intersect(A.get("bounds"), viewport)
+                return 1 if visible else 2
+
+            def make_queue(maxsize):
+                return KeyedPriorityQueue(priority, maxsize=maxsize)
+        else:
+            make_queue = gevent.queue.Queue
+
         to_export = gevent.queue.Queue(maxsize=512)
         if self.strava_client:
-            to_import = gevent.queue.Queue(maxsize=512)
+            to_import = make_queue(maxsize=512)
             batch_queue = gevent.queue.Queue()
         else:
             to_import = FakeQueue()
@@ -550,7 +689,8 @@ class Users(UserMixin, db_sql.Model):
 
             A = Activities.import_streams(
                 self.strava_client, A,
-                batch_queue=batch_queue)
+                batch_queue=batch_queue,
+                lod=lod)
             
             elapsed = time.time() - start
             log.debug("%s response %s in %s", self, _id, round(elapsed, 2))
@@ -574,8 +714,13 @@ class Users(UserMixin, db_sql.Model):
         stats = dict(n=0)
         import_stats = dict(n=0, err=0, emp=0, dt=0)
 
+        # per-stage timing: when the first summary came out of the index,
+        #  when the first activity was ready to send, and how long we
+        #  spent looking up chunks of summaries in the cache
+        pipeline_stats = dict(chunks=0, chunked=0, fetch_dt=0)
+
         import_pool = gevent.pool.Pool(IMPORT_CONCURRENCY)
-        aux_pool = gevent.pool.Pool(3)
+        aux_pool = gevent.pool.Pool(4)
        
         if self.strava_client:
             # this is a lazy iterator that pulls activites from import queue
@@ -601,22 +746,49 @@ class Users(UserMixin, db_sql.Model):
             # with activities from imported
             aux_pool.spawn(handle_imported, imported).link(imported_done)
 
+        # background job moving summaries from the index into a queue,
+        #  so that we can look them up in chunks without waiting
+        #  for a chunk to fill up
+        raw_queue = make_queue(maxsize=2 * BATCH_CHUNK_SIZE)
+
+        def read_summaries():
+            for A in summaries_generator:
+                if self.abort_signal:
+                    break
+                if A and "_id" in A and "first_summary" not in pipeline_stats:
+                    pipeline_stats["first_summary"] = timer.elapsed()
+                raw_queue.put(A)
+
+        def summaries_done(dummy):
+            raw_queue.put(StopIteration)
+
+        aux_pool.spawn(read_summaries).link(summaries_done)
+
         # background job filling import and export queues
         #  it will pause when either queue is full
-        chunks = Utility.chunks(summaries_generator, size=BATCH_CHUNK_SIZE)
+        chunks = Utility.timed_chunks(
+            raw_queue,
+            size=BATCH_CHUNK_SIZE,
+            timeout=BATCH_CHUNK_TIMEOUT
+        )
 
         def process_chunks(chunks):
             for chunk in chunks:
                 handle_raw(chunk)
 
         def handle_raw(raw_summaries):
-            for A in Activities.append_streams_from_db(raw_summaries):
+            start = time.time()
+            pipeline_stats["chunks"] += 1
+            pipeline_stats["chunked"] += len(raw_summaries)
+            fetched = Activities.append_streams_from_db(raw_summaries, lod=lod)
+            for A in fetched:
                 handle_fetched(A)
+            pipeline_stats["fetch_dt"] += time.time() - start
 
         def handle_fetched(A):
             if not A or self.abort_signal:
                 return
-            if "time" in A:
+            if Activities.PACKED_STREAMS in A:
                 to_export.put(A)
                 stats["n"] += 1
             elif "_id" not in A:
@@ -634,7 +806,11 @@ class Users(UserMixin, db_sql.Model):
         aux_pool.spawn(process_chunks, chunks).link(raw_done)
 
         count = 0
-        for A in map(export, to_export):
+        for A in to_export:
+            _id = A.get("_id") if isinstance(A, dict) else None
+            A = export(A)
+            if count == 0:
+                pipeline_stats["first_export"] = timer.elapsed()
             self.abort_signal = yield A
             count += 1
 
@@ -643,6 +819,9 @@ class Users(UserMixin, db_sql.Model):
                 summaries_generator.send(abort_signal)
                 break
 
+            if _id and on_sent:
+                on_sent(_id)
+
         elapsed = timer.elapsed()
         stats["dt"] = round(elapsed, 2)
         stats = Utility.cleandict(stats)
@@ -650,6 +829,9 @@ class Users(UserMixin, db_sql.Model):
         if import_stats:
             batch_queue.put(StopIteration)
             write_result = Activities.set_many(batch_queue)
+            if import_stats.get("n"):
+                # tiles rendered before we had these streams lack them
+                Tiles.invalidate(self.id)
             try:
                 import_stats["t_rel"] = round(
                     import_stats.pop("dt") / elapsed, 2)
@@ -661,6 +843,12 @@ class Users(UserMixin, db_sql.Model):
         
         if "n" in stats:
             log.info("%s fetch %s", self, stats)
+
+        if pipeline_stats["chunks"]:
+            pipeline_stats["chunk_size"] = round(
+                pipeline_stats["chunked"] / pipeline_stats["chunks"], 1)
+            pipeline_stats["fetch_dt"] = round(pipeline_stats["fetch_dt"], 2)
+            log.info("%s pipeline %s", self, pipeline_stats)
         
         if import_stats:
             stats["import"] = import_stats
@@ -676,9 +864,283 @@ class Users(UserMixin, db_sql.Model):
         return Payments.get(self, after=after, before=before)
 
 
+# TTLToucher refreshes the "ts" field (which the TTL index on a
+#  collection expires documents by) for documents that have been read.
+#  Rather than an update_many every time we read something, ids are
+#  collected and written in one update every interval seconds, on a
+#  background greenlet.  Ids we refreshed less than min_age seconds ago
+#  are skipped, since their TTL is nowhere near running out.
+class TTLToucher(object):
+    CHUNK_SIZE = 1000
+
+    def __init__(
+        self,
+        collection,
+        interval=TTL_TOUCH_INTERVAL,
+        min_age=TTL_TOUCH_MIN_AGE
+    ):
+        self.collection = collection
+        self.interval = interval
+        self.min_age = min_age
+        self.pending = set()
+        self.recent = {}
+        self.flusher = None
+        self.stats = dict(touched=0, skipped=0, written=0, flushes=0)
+
+    def touch(self, ids):
+        now = time.time()
+        for _id in ids:
+            self.stats["touched"] += 1
+            last = self.recent.get(_id)
+            if last and (now - last < self.min_age):
+                self.stats["skipped"] += 1
+                continue
+            self.pending.add(_id)
+
+        if self.pending and not self.flusher:
+            self.flusher = gevent.spawn_later(self.interval, self._flush)
+
+    def _flush(self):
+        self.flusher = None
+        self.flush()
+
+    def flush(self):
+        ids, self.pending = list(self.pending), set()
+        if not ids:
+            return
+
+        now = time.time()
+        dt = datetime.utcnow()
+        for chunk in Utility.chunks(ids, size=self.CHUNK_SIZE):
+            try:
+                self.collection.update_many(
+                    {"_id": {"$in": list(chunk)}},
+                    {"$set": {"ts": dt}}
+                )
+            except Exception:
+                log.exception(
+                    "error updating ts in '%s'", self.collection.name
+                )
+            else:
+                self.stats["written"] += len(chunk)
+        self.stats["flushes"] += 1
+
+        # forget ids that are old enough to be touched again
+        self.recent = {
+            _id: t for _id, t in self.recent.items()
+            if now - t < self.min_age
+        }
+        self.recent.update((_id, now) for _id in ids)
+
+    def info(self):
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            recent=len(self.recent)
+        )
+
+
 class Index(object):
     name = "index"
     db = mongodb.get_collection(name)
+    toucher = TTLToucher(db)
+
+    #  Every Index.query is for one user's activities, sorted by ts_UTC
+    #  (newest first), optionally filtered by a ts_local range and/or
+    #  a list of ids.  With all of those fields in one index, in that
+    #  order (equality, sort, range), MongoDB never has to sort
+    #  in memory, and queries that only ask for _id are covered by
+    #  the index (no documents are fetched).
+    QUERY_INDEX_NAME = "user_ts"
+    QUERY_INDEX = [
+        ("user_id", pymongo.ASCENDING),
+        ("ts_UTC", pymongo.DESCENDING),
+        ("ts_local", pymongo.ASCENDING),
+        ("_id", pymongo.ASCENDING)
+    ]
+
+    # Queries for activities in a map area (bbox) compare it with "box",
+    #  each activity's bounds as separate S, W, N, E (degrees) fields.
+    #  Map areas are lat/lng rectangles, so plain range comparisons
+    #  are exactly right, where a GeoJSON polygon would have great
+    #  circle edges.
+    BOX_INDEX_NAME = "user_box"
+    BOX_INDEX = [
+        ("user_id", pymongo.ASCENDING),
+        ("box.S", pymongo.ASCENDING),
+        ("box.N", pymongo.ASCENDING),
+        ("box.W", pymongo.ASCENDING),
+        ("box.E", pymongo.ASCENDING)
+    ]
+
+    # indexes that QUERY_INDEX and BOX_INDEX replace
+    OLD_INDEXES = ["user_id_1_ts_local_-1", "user_geo"]
+
+    @classmethod
+    def ensure_indexes(cls):
+        try:
+            cls.db.create_index(cls.QUERY_INDEX, name=cls.QUERY_INDEX_NAME)
+            cls.db.create_index(cls.BOX_INDEX, name=cls.BOX_INDEX_NAME)
+            existing = cls.db.index_information()
+            for name in cls.OLD_INDEXES:
+                if name in existing:
+                    cls.db.drop_index(name)
+                    log.info("dropped '%s' index %s", cls.name, name)
+        except Exception:
+            log.exception("error creating '%s' indexes", cls.name)
+
+    @classmethod
+    def _find(cls, query, projection=None, limit=0):
+        # All Index queries go through here, so that they use the
+        #  right sort order and index
+        cursor = cls.db.find(query, projection)
+        cursor = cursor.sort("ts_UTC", pymongo.DESCENDING).limit(limit)
+        if "box.S" in query:
+            # The box index narrows it down to a (usually) small
+            #  number of activities, which are then sorted.
+            cursor = cursor.hint(cls.BOX_INDEX_NAME)
+        elif "user_id" in query:
+            cursor = cursor.hint(cls.QUERY_INDEX_NAME)
+        return cursor
+
+    @staticmethod
+    def bounds_box(bounds):
+        # "box" fields for bounds ({"SW": (lat, lng), "NE": (lat, lng)})
+        (s, w), (n, e) = bounds["SW"], bounds["NE"]
+        return {"S": s, "W": w, "N": n, "E": e}
+
+    @staticmethod
+    def box_area(sw, ne):
+        # The map area with corners sw and ne (lat, lng) as
+        #  (south, north, lngs), where lngs is a list of (west, east)
+        #  ranges within [-180, 180], or None for all longitudes.
+        #  Longitudes may go past +/-180 (the map wraps around), and an
+        #  area 360 degrees wide or more covers all longitudes.  Raises
+        #  ValueError for a bad area.
+        (s, w), (n, e) = sw, ne
+        s, w, n, e = (float(x) for x in (s, w, n, e))
+        if not (-90 <= s <= n <= 90) or w > e:
+            raise ValueError("invalid bbox {}".format((sw, ne)))
+
+        if e - w >= 360:
+            return s, n, None
+
+        # shift the area so that its west edge is in [-180, 180)
+        shift = ((w + 180) % 360) - 180 - w
+        w, e = w + shift, e + shift
+        if e <= 180:
+            return s, n, [(w, e)]
+
+        # it crosses the antimeridian, so it is two areas
+        return s, n, [(w, 180), (-180, e - 360)]
+
+    @classmethod
+    def box_query(cls, sw, ne):
+        # Query for activities whose bounds overlap the map area with
+        #  corners sw and ne (see box_area)
+        s, n, lngs = cls.box_area(sw, ne)
+        query = {"box.S": {"$lte": n}, "box.N": {"$gte": s}}
+        if lngs is None:
+            return query
+
+        ranges = []
+        for w, e in lngs:
+            # leave out conditions that every activity meets
+            overlap = {}
+            if e < 180:
+                overlap["box.W"] = {"$lte": e}
+            if w > -180:
+                overlap["box.E"] = {"$gte": w}
+            ranges.append(overlap)
+
+        if len(ranges) == 1:
+            query.update(ranges[0])
+        else:
+            query["$or"] = ranges
+        return query
+
+    @classmethod
+    def backfill_box(cls):
+        # Add "box" to index entries that were made before we had it,
+        #  and drop the "geo" field that it replaces
+        timer = Timer()
+        writer = BulkWriter(cls.db)
+        stats = dict(n=0)
+        cursor = cls.db.find(
+            {"box": {"$exists": False}, "bounds.SW": {"$exists": True}},
+            {"bounds": True}
+        )
+        for doc in cursor:
+            stats["n"] += 1
+            try:
+                box = cls.bounds_box(doc["bounds"])
+            except Exception:
+                continue
+            writer.put(pymongo.UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"box": box}, "$unset": {"geo": ""}}
+            ))
+
+        stats.update(writer.close())
+        stats["dt"] = timer.elapsed()
+        msg = "{} box backfill {}".format(cls.name, stats)
+        log.info(msg)
+        EventLogger.new_event(msg=msg)
+        return stats
+
+    @classmethod
+    def check_query_plans(cls, user_id=0):
+        # Explain each kind of query that Index.query makes and log any
+        #  that would need a collection scan or an in-memory sort,
+        #  or that should be covered by the index but are not.
+        now = datetime.utcnow()
+        date_range = {"$gte": now - timedelta(days=30), "$lt": now}
+        ids = {"$in": [1, 2, 3]}
+        shapes = {
+            "limit": ({}, None, 10),
+            "dates": ({"ts_local": date_range}, None, 0),
+            "ids": ({"_id": ids}, None, 0),
+            "dates_ids": ({"ts_local": date_range, "_id": ids}, None, 0),
+            # the id-only pass for queries with exclude_ids
+            "exclude_ids": ({}, {"_id": True}, 10),
+            "exclude_ids_dates": (
+                {"ts_local": date_range}, {"_id": True}, 0
+            ),
+        }
+
+        def stages(plan):
+            if isinstance(plan, dict):
+                if "stage" in plan:
+                    yield plan["stage"]
+                for val in plan.values():
+                    for stage in stages(val):
+                        yield stage
+            elif isinstance(plan, list):
+                for val in plan:
+                    for stage in stages(val):
+                        yield stage
+
+        bad = {}
+        for shape, (query, projection, limit) in shapes.items():
+            query = dict(query, user_id=user_id)
+            try:
+                plan = cls._find(query, projection, limit).explain()
+            except Exception:
+                log.exception("error explaining %s query", shape)
+                continue
+
+            found = set(stages(plan["queryPlanner"]["winningPlan"]))
+            problems = found & {"COLLSCAN", "SORT"}
+            if projection and "FETCH" in found:
+                problems.add("FETCH")
+            if problems:
+                bad[shape] = sorted(problems)
+
+        if bad:
+            log.warning("'%s' query plan problems: %s", cls.name, bad)
+        else:
+            log.info("'%s' query plans ok", cls.name)
+        return bad
     
     @classmethod
     # Initialize the database
@@ -689,10 +1151,7 @@ class Index(object):
         
             # create new index collection
             mongodb.create_collection(cls.name)
-            cls.db.create_index([
-                ("user_id", pymongo.ASCENDING),
-                ("ts_local", pymongo.DESCENDING)
-            ])
+            cls.ensure_indexes()
 
             cls.db.create_index(
                 "ts",
@@ -706,6 +1165,7 @@ class Index(object):
             )
 
         log.info("initialized '%s' collection:", cls.name)
+        UserStats.init_db()
 
     @classmethod
     def update_ttl(cls, timeout=TTL_INDEX):
@@ -736,11 +1196,19 @@ class Index(object):
     @classmethod
     def delete(cls, id):
         try:
-            return cls.db.delete_one({"_id": id})
+            doc = cls.db.find_one_and_delete(
+                {"_id": id},
+                projection={"user_id": True}
+            )
         except Exception:
             log.exception("error deleting index summary %s", id)
             return
 
+        if doc:
+            Tiles.invalidate(doc["user_id"])
+            UserStats.mark_stale(doc["user_id"])
+        return doc
+
     @classmethod
     def update(cls, id, updates, replace=False):
         if not updates:
@@ -754,20 +1222,34 @@ class Index(object):
             except Exception:
                 log.exception("mongodb error")
                 return
+            if "user_id" in updates:
+                UserStats.mark_stale(updates["user_id"])
 
         if "title" in updates:
             updates["name"] = updates["title"]
             del updates["title"]
 
         try:
-            return cls.db.update_one({"_id": id}, {"$set": updates})
+            result = cls.db.find_one_and_update(
+                {"_id": id},
+                {"$set": updates},
+                projection={"user_id": True}
+            )
         except Exception:
             log.exception("mongodb error")
+            return
+
+        # A change of type changes the user's counts by type
+        if result and "type" in updates:
+            UserStats.mark_stale(result["user_id"])
+        return result
 
     @classmethod
     def delete_user_entries(cls, user):
         try:
             result = cls.db.delete_many({"user_id": user.id})
+            Tiles.invalidate(user.id)
+            UserStats.clear(user.id)
             log.debug("deleted index entries for %s", user)
             return result
         except Exception:
@@ -778,6 +1260,10 @@ class Index(object):
 
     @classmethod
     def user_index_size(cls, user):
+        stats = UserStats.get(user.id)
+        if stats is not None:
+            return stats["count"]
+
         try:
             activity_count = cls.db.count_documents({"user_id": user.id})
         except Exception:
@@ -822,6 +1308,7 @@ class Index(object):
         check_dates = (before or after)
 
         limit = out_query.get("limit")
+        bbox = out_query.get("bbox")
 
         #  If we are getting the most recent n activities (limit) then
         #  we will need them to be in order.
@@ -830,8 +1317,8 @@ class Index(object):
             fetch_query["ordered"] = True
         
         count = 0
+        matched = 0
         in_range = False
-        mongo_requests = []
         user = client.user
         user.indexing(0)
 
@@ -848,8 +1335,11 @@ class Index(object):
         if not (queue and out_query):
             queue = FakeQueue()
         
-        if out_query:
-            yielding = True
+        yielding = bool(out_query)
+
+        #  Index entries are written as we go, so the index is usable
+        #  (and survives a failed import) before we are done
+        writer = BulkWriter(cls.db, on_written=cls._indexed)
         
         try:
             
@@ -870,7 +1360,12 @@ class Index(object):
                     user.indexing(count)
                     queue.put({"idx": count})
 
-                if yielding:
+                if yielding and bbox and not Utility.bounds_intersect(
+                        d.get("bounds"), bbox):
+                    # not in the requested map area
+                    pass
+
+                elif yielding:
                     d2 = d.copy()
 
                     # cases for outputting this activity summary
@@ -883,7 +1378,10 @@ class Index(object):
                                     raise StopIteration
                         
                         elif limit:
-                            if count <= limit:
+                            # the newest limit activities that are in
+                            #  the requested map area, like Index.query
+                            matched += 1
+                            if matched <= limit:
                                 queue.put(d2)
                             else:
                                 raise StopIteration
@@ -919,15 +1417,13 @@ class Index(object):
                 else:
                     d["ts_local"] = Utility.to_datetime(d["ts_local"])
 
-                mongo_requests.append(
-                    pymongo.ReplaceOne({"_id": d["_id"]}, d, upsert=True)
+                writer.put(
+                    pymongo.ReplaceOne({"_id": d["_id"]}, d, upsert=True),
+                    size=len(bson.encode(d)),
+                    item=d
                 )
-                  
-            if mongo_requests:
-                result = cls.db.bulk_write(
-                    list(mongo_requests),
-                    ordered=False)
-                # log.debug(result.bulk_api_result)
+
+            writer.close()
 
         except Exception as e:
             log.exception("%s index import error", user)
@@ -939,18 +1435,90 @@ class Index(object):
                 user,
                 dict(
                     dt=elapsed, n=count,
-                    rate=round(count / elapsed, 2)) if elapsed else None
+                    rate=round(count / elapsed, 2),
+                    written=writer.stats["written"],
+                    batches=writer.stats["batches"],
+                    errors=writer.stats["errors"]) if elapsed else None
                 )
 
             log.info(msg)
-            EventLogger.new_event(msg=msg)
+            if count:
+                EventLogger.new_event(msg=msg)
             queue.put(dict(
                 msg="done indexing {} activities.".format(count)
             ))
         finally:
+            writer.close()
             queue.put(StopIteration)
             user.indexing(False)
 
+    @staticmethod
+    def _indexed(docs, result):
+        # docs were written to the index with ReplaceOne upserts.
+        #  The ones that were inserted (not replaced) are new, so we
+        #  add them to their users' stats, and their users' tiles are
+        #  out of date.
+        new = [docs[i] for i in result.upserted_ids]
+        UserStats.add(new)
+        for user_id in set(d["user_id"] for d in new):
+            Tiles.invalidate(user_id)
+
+    @classmethod
+    def newest_ts(cls, user):
+        # The (UTC) start time of the most recent activity in
+        #  this user's index
+        try:
+            doc = cls.db.find_one(
+                {"user_id": user.id},
+                {"ts_UTC": True},
+                sort=[("ts_UTC", pymongo.DESCENDING)]
+            )
+        except Exception:
+            log.exception("error getting newest index entry for %s", user)
+            return
+
+        if doc:
+            return Utility.to_datetime(doc["ts_UTC"])
+
+    @classmethod
+    def refresh_user_index(cls, client, force=False):
+        # Import only the activities that are newer than the newest one
+        #  we already have, instead of paging through the user's
+        #  entire Strava history.  Returns False if there was
+        #  nothing to refresh from or we refreshed recently.
+        user = client.user
+        key = "IDXR:{}".format(user.id)
+        if not force and INDEX_REFRESH_INTERVAL:
+            try:
+                due = redis.set(key, 1, ex=INDEX_REFRESH_INTERVAL, nx=True)
+            except Exception:
+                log.exception("%s index refresh check failed", user)
+                return False
+            if not due:
+                return False
+
+        after = cls.newest_ts(user)
+        if not after:
+            return False
+
+        # There is usually less than a page of new activities, so we
+        #  request pages one at a time and stop at the first short one,
+        #  rather than use up rate limit on pages that turn out empty.
+        #  A failed refresh is nothing to worry about (we'll try again
+        #  next time), so it mustn't delete the user like a failed
+        #  index build does.
+        fetch_query = dict(
+            after=after,
+            concurrency=1,
+            delete_user_on_error=False
+        )
+        try:
+            cls._import(client, fetch_query=fetch_query)
+        except Exception:
+            log.exception("%s index refresh failed", user)
+            return False
+        return True
+
     @classmethod
     def import_user_index(
         cls,
@@ -995,7 +1563,10 @@ class Index(object):
         
     @classmethod
     def import_by_id(cls, user, activity_ids):
-        client = StravaClient(user=user)
+        client = StravaClient(
+            user=user,
+            priority=StravaRateLimiter.BACKGROUND
+        )
         if not client:
             return
 
@@ -1004,6 +1575,7 @@ class Index(object):
 
         import_stats = dict(errors=0, imported=0, empty=0)
         mongo_requests = []
+        docs = []
         timer = Timer()
         for d in pool.imap_unordered(client.get_activity, activity_ids):
             if not d:
@@ -1019,10 +1591,12 @@ class Index(object):
             mongo_requests.append(
                 pymongo.ReplaceOne({"_id": d["_id"]}, d, upsert=True)
             )
+            docs.append(d)
 
         if mongo_requests:
             try:
-                cls.db.bulk_write(mongo_requests, ordered=False)
+                result = cls.db.bulk_write(mongo_requests, ordered=False)
+                cls._indexed(docs, result)
             except Exception:
                 log.exception("mongo error")
             else:
@@ -1036,7 +1610,9 @@ class Index(object):
     def query(cls, user=None,
               activity_ids=None,
               exclude_ids=None,
+              exclude_digest=None,
               after=None, before=None,
+              bbox=None,
               limit=0,
               update_ts=True
               ):
@@ -1044,6 +1620,12 @@ class Index(object):
         if activity_ids:
             activity_ids = set(int(id) for id in activity_ids)
 
+        # The ids of activities the client already has can be given as
+        #  a list (exclude_ids) or more compactly as a digest
+        #  (see codecs.id_digest_decode)
+        if exclude_digest:
+            exclude_ids = codecs.id_digest_decode(exclude_digest).tolist()
+
         if exclude_ids:
             exclude_ids = set(int(id) for id in exclude_ids)
 
@@ -1054,7 +1636,7 @@ class Index(object):
 
         if user:
             query["user_id"] = user.id
-            out_fields = {"user_id": False}
+            out_fields = {"user_id": False, "box": False}
 
         tsfltr = {}
         if before:
@@ -1071,68 +1653,388 @@ class Index(object):
         if activity_ids:
             query["_id"] = {"$in": list(activity_ids)}
 
-        to_delete = None
-        
-        if exclude_ids:
+        if bbox:
+            # only activities whose bounds overlap bbox
+            #  ([[south, west], [north, east]])
             try:
-                result = cls.db.find(
-                    query,
-                    {"_id": True}
-                ).sort(
-                    "ts_local",
-                    pymongo.DESCENDING
-                ).limit(limit)
+                query.update(cls.box_query(*bbox))
+            except Exception:
+                yield {"error": "Invalid bbox"}
+                return
 
+        ids = []
+        if exclude_ids:
+            # The client expects to be told what to delete and how many
+            #  activities are coming before it gets any.  We find that
+            #  out from the ids of the query result, which the index
+            #  covers (no documents are fetched), and then fetch only
+            #  the documents the client doesn't have.
+            try:
+                result_ids = set(
+                    a["_id"] for a in cls._find(query, {"_id": True}, limit)
+                )
             except Exception:
                 log.exception("mongo error")
                 return
-            
-            query_ids = set(
-                int(doc["_id"]) for doc in result
-            )
-
-            to_delete = list(exclude_ids - query_ids)
-            to_fetch = list(query_ids - exclude_ids)
+            new_ids = result_ids - exclude_ids
+            yield {"delete": list(exclude_ids - result_ids)}
+            yield {"count": len(new_ids)}
 
-            yield {"delete": to_delete}
-            yield {"count": len(to_fetch)}
-
-            query["_id"] = {"$in": to_fetch}
+            # the ones the client has are still in use
+            if update_ts:
+                ids = list(result_ids & exclude_ids)
 
+            query = {"_id": {"$in": list(new_ids)}}
+            if user:
+                query["user_id"] = user.id
+            limit = 0
         else:
-            count = cls.db.count_documents(query)
+            try:
+                count = cls.db.count_documents(query)
+            except Exception:
+                log.exception("mongo error")
+                yield {"error": "index query failed"}
+                return
             if limit:
                 count = min(limit, count)
             yield {"count": count}
         
         try:
-            if out_fields:
-                cursor = cls.db.find(query, out_fields)
-            else:
-                cursor = cls.db.find(query)
-
-            cursor = cursor.sort("ts_UTC", pymongo.DESCENDING).limit(limit)
+            cursor = cls._find(query, out_fields, limit)
 
         except Exception:
             log.exception("mongo error")
             return
 
-        ids = set()
-
-        for a in cursor:
-            if update_ts:
-                ids.add(a["_id"])
-            yield a
+        try:
+            for a in cursor:
+                if update_ts:
+                    ids.append(a["_id"])
+                yield a
+        except Exception:
+            log.exception("mongo error")
+            yield {"error": "index query failed"}
 
         if update_ts:
+            cls.toucher.touch(ids)
+                
+
+# StravaRateLimiter paces all Strava API requests so that we stay under
+#  Strava's rate limits, which are per app (shared by all users and all
+#  of our workers).  Strava reports the limits and our current usage,
+#  for a 15-minute window and a daily window, in the X-RateLimit-Limit
+#  and X-RateLimit-Usage headers of every response.
+#
+#  It is a token bucket whose refill rate is what is left of each window's
+#  budget spread over what is left of the window.  Tokens accumulate
+#  up to a fraction of that budget, so a single import can go fast while
+#  there is plenty of room.  Requests waiting for a token are served in
+#  order of priority, and background requests can't use the last
+#  reserve fraction of the 15-minute budget.  After a 429 response
+#  nobody gets a token until the backoff time is up.
+#
+#  With use_redis, the bucket and the usage counts live in Redis and
+#  every worker takes its tokens from there (atomically, with a Lua
+#  script), so all of them together stay within one budget.  If Redis
+#  is unavailable we fall back to a bucket for this worker alone.
+class StravaRateLimiter(object):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    # Strava's windows reset every 15 minutes on the quarter-hour and
+    #  daily at midnight UTC
+    WINDOWS = (15 * 60, 24 * 60 * 60)
+    BURST_FRACTION = 0.25
+    MAX_SLEEP = 0.5
+
+    BUCKET_KEY = "RL:bucket"
+    BLOCKED_KEY = "RL:blocked"
+
+    # _take_local, done in Redis for all workers.
+    #  KEYS: bucket, blocked, 15-minute usage, daily usage
+    #  ARGV: now, limits (2), safety, reserve, burst fraction,
+    #        background (0/1), seconds left in each window (2),
+    #        window lengths (2)
+    #  returns [ok, wait (string), 15-minute usage, daily usage]
+    TAKE_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local limits = {tonumber(ARGV[2]), tonumber(ARGV[3])}
+        local safety = tonumber(ARGV[4])
+        local reserve = tonumber(ARGV[5])
+        local burst_fraction = tonumber(ARGV[6])
+        local background = ARGV[7] == "1"
+        local left = {tonumber(ARGV[8]), tonumber(ARGV[9])}
+        local windows = {tonumber(ARGV[10]), tonumber(ARGV[11])}
+
+        local usage = {
+            tonumber(redis.call("GET", KEYS[3]) or "0"),
+            tonumber(redis.call("GET", KEYS[4]) or "0")
+        }
+        local blocked = tonumber(redis.call("GET", KEYS[2]) or "0")
+        if blocked > now then
+            return {0, tostring(blocked - now), usage[1], usage[2]}
+        end
+
+        local remaining = {}
+        local rate = nil
+        local exhausted = 0
+        for i = 1, 2 do
+            remaining[i] = math.max(0, safety * limits[i] - usage[i])
+            local r = remaining[i] / left[i]
+            if rate == nil or r < rate then
+                rate = r
+            end
+            if remaining[i] == 0 then
+                exhausted = math.max(exhausted, left[i])
+            end
+        end
+
+        if background and remaining[1] <= reserve * limits[1] then
+            return {0, tostring(left[1]), usage[1], usage[2]}
+        end
+
+        local burst = math.max(
+            1, burst_fraction * math.min(remaining[1], remaining[2])
+        )
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+        local tokens = tonumber(bucket[1]) or burst
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + rate * math.max(0, now - ts))
+
+        local ok = 0
+        local wait = 0
+        if tokens >= 1 then
+            ok = 1
+            tokens = tokens - 1
+            for i = 1, 2 do
+                usage[i] = redis.call("INCR", KEYS[2 + i])
+                redis.call("EXPIRE", KEYS[2 + i], windows[i])
+            end
+        elseif rate > 0 then
+            wait = (1 - tokens) / rate
+        else
+            wait = exhausted
+        end
+        redis.call(
+            "HMSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now)
+        )
+        redis.call("EXPIRE", KEYS[1], windows[1])
+        return {ok, tostring(wait), usage[1], usage[2]}
+    """
+
+    # Raise the shared usage counts to what Strava reports
+    #  KEYS: 15-minute usage, daily usage
+    #  ARGV: reported usage (2), window lengths (2)
+    USAGE_SCRIPT = """
+        for i = 1, 2 do
+            local usage = tonumber(redis.call("GET", KEYS[i]) or "0")
+            if tonumber(ARGV[i]) > usage then
+                redis.call("SET", KEYS[i], ARGV[i], "EX", ARGV[2 + i])
+            end
+        end
+    """
+
+    def __init__(self, limits, safety=0.9, reserve=0.2, use_redis=False):
+        self.limits = list(limits)
+        self.usage = [0, 0]
+        self.safety = safety
+        self.reserve = reserve
+        self.use_redis = use_redis
+        self.scripts = {}
+
+        now = time.time()
+        self.window_ids = [int(now // w) for w in self.WINDOWS]
+        # start with a full bucket
+        self.tokens = max(1.0, self.BURST_FRACTION * min(self._remaining()))
+        self.last_refill = now
+        self.blocked_until = 0
+
+        self.waiting = gevent.queue.PriorityQueue()
+        self.count = itertools.count()
+        self.dispatcher = None
+        self.stats = dict(
+            requests=0, waited=0, wait_dt=0, throttled=0, refused=0
+        )
+
+    def _rollover(self, now):
+        for i, w in enumerate(self.WINDOWS):
+            window_id = int(now // w)
+            if window_id != self.window_ids[i]:
+                self.window_ids[i] = window_id
+                self.usage[i] = 0
+
+    def _remaining(self):
+        return [
+            max(0, self.safety * limit - usage)
+            for limit, usage in zip(self.limits, self.usage)
+        ]
+
+    def _usage_keys(self):
+        return [
+            "RL:{}:{}".format(w, window_id)
+            for w, window_id in zip(self.WINDOWS, self.window_ids)
+        ]
+
+    def _script(self, name):
+        # Scripts are registered on first use, when redis is ready
+        if name not in self.scripts:
+            self.scripts[name] = redis.register_script(
+                getattr(self, name + "_SCRIPT")
+            )
+        return self.scripts[name]
+
+    def _refill(self, now):
+        self._rollover(now)
+        remaining = self._remaining()
+        rate = min(
+            r / (w - now % w) for r, w in zip(remaining, self.WINDOWS)
+        )
+        burst = max(1.0, self.BURST_FRACTION * min(remaining))
+        self.tokens = min(burst, self.tokens + rate * (now - self.last_refill))
+        self.last_refill = now
+        return rate
+
+    def _take(self, priority):
+        # Take a token if we can.  Returns (True, 0) if we did, or
+        #  (False, about how long until we can)
+        now = time.time()
+        if self.use_redis:
+            try:
+                return self._take_shared(priority, now)
+            except Exception:
+                log.exception("rate limiter redis error")
+        return self._take_local(priority, now)
+
+    def _take_shared(self, priority, now):
+        self._rollover(now)
+        args = [now] + self.limits + [
+            self.safety,
+            self.reserve,
+            self.BURST_FRACTION,
+            int(priority == self.BACKGROUND)
+        ]
+        args += [w - now % w for w in self.WINDOWS] + list(self.WINDOWS)
+        ok, wait, usage_15min, usage_day = self._script("TAKE")(
+            keys=[self.BUCKET_KEY, self.BLOCKED_KEY] + self._usage_keys(),
+            args=args
+        )
+        self.usage = [int(usage_15min), int(usage_day)]
+        return bool(ok), float(wait)
+
+    def _take_local(self, priority, now):
+        rate = self._refill(now)
+        if self.blocked_until > now:
+            return False, self.blocked_until - now
+
+        if priority == self.BACKGROUND:
+            remaining = self._remaining()[0]
+            if remaining <= self.reserve * self.limits[0]:
+                return False, self.WINDOWS[0] - now % self.WINDOWS[0]
+
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / rate if rate else self.MAX_SLEEP
+            return False, wait
+
+        self.tokens -= 1
+        self.usage = [u + 1 for u in self.usage]
+        return True, 0
+
+    def acquire(self, priority=INTERACTIVE, max_wait=None):
+        # Wait until we can make a request, but no more than max_wait
+        #  seconds.  Returns whether we can.
+        self.stats["requests"] += 1
+
+        first_in_line = (
+            self.waiting.empty() or priority < self.waiting.peek()[0]
+        )
+        if first_in_line:
+            ok, wait = self._take(priority)
+            if ok:
+                return True
+            if max_wait is not None and wait > max_wait:
+                self.stats["refused"] += 1
+                return False
+
+        waiter = dict(ready=gevent.event.Event(), cancelled=False)
+        self.waiting.put((priority, next(self.count), waiter))
+        if not self.dispatcher:
+            self.dispatcher = gevent.spawn(self._dispatch)
+
+        start = time.time()
+        ok = waiter["ready"].wait(max_wait)
+        self.stats["waited"] += 1
+        self.stats["wait_dt"] += time.time() - start
+        if not ok:
+            waiter["cancelled"] = True
+            self.stats["refused"] += 1
+        return ok
+
+    def _dispatch(self):
+        while not self.waiting.empty():
+            priority, count, waiter = self.waiting.peek()
+            if waiter["cancelled"]:
+                self.waiting.get()
+                continue
+            ok, wait = self._take(priority)
+            if ok:
+                self.waiting.get()
+                waiter["ready"].set()
+            else:
+                gevent.sleep(min(wait, self.MAX_SLEEP))
+        self.dispatcher = None
+
+    def update(self, headers):
+        # Update limits and usage from a Strava response's headers
+        try:
+            limits = headers.get("X-RateLimit-Limit")
+            usage = headers.get("X-RateLimit-Usage")
+            if not (limits and usage):
+                return
+            self.limits = [int(x) for x in limits.split(",")]
+            usage = [int(x) for x in usage.split(",")]
+        except Exception:
+            log.exception("bad rate limit headers %s", headers)
+            return
+
+        self._rollover(time.time())
+        self.usage = [max(u, h) for u, h in zip(self.usage, usage)]
+
+        if self.use_redis:
             try:
-                result = cls.db.update_many(
-                    {"_id": {"$in": list(ids)}},
-                    {"$set": {"ts": datetime.utcnow()}}
+                self._script("USAGE")(
+                    keys=self._usage_keys(),
+                    args=usage + list(self.WINDOWS)
                 )
             except Exception:
-                log.exception("mongo error")
-                
+                log.exception("rate limiter redis error")
+
+    def throttled(self, attempt):
+        # We got a 429 response.  Nobody gets a token for a while
+        #  (exponential backoff, with jitter), and we return how long.
+        #  What is left of our budget comes from the response headers.
+        self.stats["throttled"] += 1
+        backoff = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+        until = time.time() + backoff
+        self.blocked_until = max(self.blocked_until, until)
+
+        if self.use_redis:
+            try:
+                redis.set(self.BLOCKED_KEY, until, px=int(1000 * backoff))
+            except Exception:
+                log.exception("rate limiter redis error")
+        return backoff
+
+    def info(self):
+        info = dict(self.stats)
+        info.update(
+            limits=self.limits,
+            usage=self.usage,
+            waiting=self.waiting.qsize(),
+            shared=self.use_redis,
+            blocked=round(max(0, self.blocked_until - time.time()), 1)
+        )
+        return info
+
 
 class StravaClient(object):
     # Stravalib includes a lot of unnecessary overhead
@@ -1144,7 +2046,33 @@ class StravaClient(object):
     STREAMS_TO_IMPORT = app.config["STREAMS_TO_IMPORT"]
     # MAX_PAGE = 3  # for testing
 
-    BASE_URL = "https://www.strava.com/api/v3"
+    BASE_URL = app.config["STRAVA_API_URL"]
+
+    # All clients in this worker share one HTTP session, so requests
+    #  reuse (keep-alive) connections instead of making a new TCP+TLS
+    #  connection to Strava every time.  The pool is big enough for
+    #  all of our concurrent stream and index page requests.
+    POOL_SIZE = IMPORT_CONCURRENCY + PAGE_REQUEST_CONCURRENCY
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not app.config["STRAVA_GZIP"]:
+        session.headers["Accept-Encoding"] = "identity"
+
+    # per-host request stats
+    host_stats = {}
+
+    # All requests from this worker go through one rate limiter.
+    #  Interactive requests wait at most MAX_WAIT seconds for it.
+    limiter = StravaRateLimiter(
+        app.config["STRAVA_RATE_LIMITS"],
+        safety=app.config["STRAVA_RATE_LIMIT_SAFETY"],
+        reserve=app.config["STRAVA_RATE_LIMIT_RESERVE"],
+        use_redis=app.config["STRAVA_RATE_LIMIT_REDIS"]
+    )
+    MAX_RETRIES = app.config["STRAVA_MAX_RETRIES"]
+    MAX_WAIT = app.config["STRAVA_RATE_LIMIT_MAX_WAIT"]
     
     GET_ACTIVITIES_ENDPOINT = "/athlete/activities?per_page={page_size}"
     GET_ACTIVITIES_URL = BASE_URL + GET_ACTIVITIES_ENDPOINT.format(
@@ -1160,9 +2088,15 @@ class StravaClient(object):
     GET_ACTIVITY_ENDPOINT = "/activities/{id}?include_all_efforts=false"
     GET_ACTIVITY_URL = BASE_URL + GET_ACTIVITY_ENDPOINT.format(id="{id}")
 
-    def __init__(self, access_token=None, user=None):
+    def __init__(
+        self,
+        access_token=None,
+        user=None,
+        priority=StravaRateLimiter.INTERACTIVE
+    ):
         self.user = user
         self.id = str(user)
+        self.priority = priority
         self.cancel_stream_import = False
         self.cancel_index_import = False
 
@@ -1178,13 +2112,14 @@ class StravaClient(object):
         return "C:{}".format(self.id)
 
     @classmethod
-    def strava2doc(cls, a):
+    def strava2doc(cls, a, bounds=None):
         if ("id" not in a) or not a["start_latlng"]:
             return
         
         try:
-            polyline = a["map"]["summary_polyline"]
-            bounds = Activities.bounds(polyline)
+            if bounds is None:
+                polyline = a["map"]["summary_polyline"]
+                bounds = Activities.bounds(polyline)
             d = dict(
                 _id=a["id"],
                 user_id=a["athlete"]["id"],
@@ -1199,6 +2134,8 @@ class StravaClient(object):
                 start_latlng=a["start_latlng"],
                 bounds=bounds
             )
+            if bounds:
+                d["box"] = Index.bounds_box(bounds)
         except KeyError:
             return
         except Exception:
@@ -1206,18 +2143,106 @@ class StravaClient(object):
             return
         return d
 
+    @staticmethod
+    def _summary_bounds(summaries):
+        # Bounds of the summary polyline of each of a page of summaries,
+        #  or None where we can't get them (strava2doc will find out why)
+        bounds = []
+        for a in summaries:
+            try:
+                bounds.append(Activities.bounds(a["map"]["summary_polyline"]))
+            except Exception:
+                bounds.append(None)
+        return bounds
+
+    @classmethod
+    def strava2docs(cls, summaries):
+        # strava2doc for a page of summaries, decoding all of their
+        #  polylines in one go, off the event loop
+        bounds = cpu_pool.run(cls._summary_bounds, summaries)
+        return [cls.strava2doc(a, b) for a, b in zip(summaries, bounds)]
+
     def headers(self):
         return {
             "Authorization": "Bearer {}".format(self.access_token)
         }
 
+    @staticmethod
+    def throttled_response(url):
+        # What we return instead of waiting for the rate limiter:
+        #  a 429 response, as if Strava had refused the request
+        response = requests.Response()
+        response.status_code = 429
+        response.url = url
+        return response
+
+    def get(self, url):
+        # GET url from the Strava API via the shared session, when the
+        #  rate limiter lets us.  If Strava says we have made too many
+        #  requests (429) we back off and try again.  Interactive
+        #  requests don't wait that long: if the limiter can't let
+        #  them through soon, or Strava refuses them, they get the
+        #  429 response right away.
+        cls = self.__class__
+        host = requests.utils.urlparse(url).netloc
+        stats = cls.host_stats.setdefault(
+            host, dict(requests=0, errors=0, dt=0)
+        )
+        interactive = self.priority == StravaRateLimiter.INTERACTIVE
+        max_wait = cls.MAX_WAIT if interactive else None
+
+        for attempt in range(cls.MAX_RETRIES + 1):
+            if not cls.limiter.acquire(self.priority, max_wait):
+                log.info("%s rate limited. not waiting", self)
+                return cls.throttled_response(url)
+            stats["requests"] += 1
+            start = time.time()
+            try:
+                response = cls.session.get(url, headers=self.headers())
+            except Exception:
+                stats["errors"] += 1
+                raise
+            finally:
+                stats["dt"] += time.time() - start
+
+            cls.limiter.update(response.headers)
+            if response.status_code != 429 or attempt == cls.MAX_RETRIES:
+                return response
+
+            backoff = cls.limiter.throttled(attempt)
+            if interactive:
+                return response
+            log.info("%s rate limited. retry in %.1fs", self, backoff)
+            gevent.sleep(backoff)
+
+    @classmethod
+    def pool_info(cls):
+        # Connection pool metrics for each host we talk to
+        info = {}
+        for key in cls.adapter.poolmanager.pools.keys():
+            pool = cls.adapter.poolmanager.pools[key]
+            host_info = dict(
+                connections_made=pool.num_connections,
+                requests=pool.num_requests,
+                idle=pool.pool.qsize() if pool.pool else 0,
+                maxsize=cls.POOL_SIZE
+            )
+            stats = cls.host_stats.get(pool.host)
+            if stats and stats["requests"]:
+                host_info.update(
+                    errors=stats["errors"],
+                    resp=round(stats["dt"] / stats["requests"], 3)
+                )
+            info["{}://{}".format(pool.scheme, pool.host)] = host_info
+        return info
+
     def get_raw_activity(self, _id, streams=True):
         cls = self.__class__
         # get one activity summary object from strava
         url = cls.GET_ACTIVITY_URL.format(id=_id)
         # log.debug("sent request %s", url)
         try:
-            response = requests.get(url, headers=self.headers())
+            response = self.get(url)
             response.raise_for_status()
 
             raw = response.json()
@@ -1244,8 +2269,18 @@ class StravaClient(object):
             log.exception("%s import-by-id %s failed", self, _id)
             return False
 
-    def get_activities(self, ordered=False, **query):
+    def get_activities(
+        self,
+        ordered=False,
+        concurrency=None,
+        delete_user_on_error=True,
+        **query
+    ):
+        # concurrency is how many index pages we request at a time.
+        #  A failed page request ends this, and deletes the user unless
+        #  delete_user_on_error is False.
         cls = self.__class__
+        concurrency = concurrency or cls.PAGE_REQUEST_CONCURRENCY
         self.cancel_index_import = False
 
         query_base_url = cls.GET_ACTIVITIES_URL
@@ -1289,7 +2324,7 @@ class StravaClient(object):
             page_timer = Timer()
 
             try:
-                response = requests.get(url, headers=self.headers())
+                response = self.get(url)
                 response.raise_for_status()
                 activities = response.json()
 
@@ -1322,7 +2357,7 @@ class StravaClient(object):
             return pagenum, activities
 
         tot_timer = Timer()
-        pool = gevent.pool.Pool(cls.PAGE_REQUEST_CONCURRENCY)
+        pool = gevent.pool.Pool(concurrency)
 
         num_activities_retrieved = 0
         num_pages_processed = 0
@@ -1337,7 +2372,7 @@ class StravaClient(object):
         jobs = mapper(
             request_page,
             page_iterator(),
-            maxsize=cls.PAGE_REQUEST_CONCURRENCY + 2
+            maxsize=concurrency + 2
         )
 
         try:
@@ -1345,6 +2380,11 @@ class StravaClient(object):
 
                 pagenum, activities = next(jobs)
 
+                if activities is None:
+                    # this page was past the last one, so we didn't
+                    #  request it
+                    continue
+
                 if (activities == "error"):
                     raise UserWarning("Strava error")
                    
@@ -1358,8 +2398,7 @@ class StravaClient(object):
                     # log.debug("no more pages after this")
                     self.final_index_page = pagenum
 
-                for a in activities:
-                    doc = cls.strava2doc(a)
+                for doc in cls.strava2docs(activities):
                     if not doc:
                         continue
                     
@@ -1380,7 +2419,8 @@ class StravaClient(object):
         except UserWarning:
             # TODO: find a more graceful way to do this
             log.exception("%s", activities)
-            self.user.delete()
+            if delete_user_on_error:
+                self.user.delete()
         except Exception as e:
             log.exception(e)
         
@@ -1416,7 +2456,7 @@ class StravaClient(object):
                 return stream
         
         try:
-            response = requests.get(url, headers=self.headers())
+            response = self.get(url)
             response.raise_for_status()
 
             stream_dict = response.json()
@@ -1444,12 +2484,170 @@ class StravaClient(object):
         return streams
 
 
+# EventHub fans out messages published on a Redis channel to any number
+#  of subscribers in this worker, with one Redis subscription (on a
+#  background greenlet) for all of them.  Each subscriber has a buffer of
+#  buffer_size messages, and if it falls behind we drop its oldest ones
+#  rather than hold up the others.
+class EventHub(object):
+    def __init__(self, channel, buffer_size=100):
+        self.channel = channel
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self.listener = None
+        self.stats = dict(published=0, received=0, delivered=0, dropped=0)
+
+    def publish(self, *messages):
+        # messages are bytes
+        pipe = redis.pipeline(transaction=False)
+        for message in messages:
+            pipe.publish(self.channel, message)
+        try:
+            pipe.execute()
+        except Exception:
+            log.exception("error publishing to %s", self.channel)
+        else:
+            self.stats["published"] += len(messages)
+
+    def _listen(self):
+        while self.subscribers:
+            try:
+                pubsub = redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if not self.subscribers:
+                        break
+                    self.stats["received"] += 1
+                    self._deliver(message["data"])
+                pubsub.close()
+            except Exception:
+                log.exception("%s listener error", self.channel)
+                gevent.sleep(1)
+        self.listener = None
+
+    def _deliver(self, message):
+        for sub in list(self.subscribers):
+            if len(sub.buffer) == sub.buffer.maxlen:
+                sub.dropped += 1
+                self.stats["dropped"] += 1
+            sub.buffer.append(message)
+            sub.ready.set()
+            self.stats["delivered"] += 1
+
+    def subscribe(self):
+        sub = EventHub.Subscription(self.buffer_size)
+        self.subscribers.add(sub)
+        if not self.listener:
+            self.listener = gevent.spawn(self._listen)
+        return sub
+
+    def unsubscribe(self, sub):
+        self.subscribers.discard(sub)
+
+    def info(self):
+        return dict(self.stats, subscribers=len(self.subscribers))
+
+    class Subscription(object):
+        def __init__(self, buffer_size):
+            self.buffer = deque(maxlen=buffer_size)
+            self.ready = gevent.event.Event()
+            self.dropped = 0
+
+        def get(self, timeout=None):
+            # The next message, or None if there is none after
+            #  timeout seconds
+            if not self.buffer:
+                self.ready.clear()
+                self.ready.wait(timeout)
+            if self.buffer:
+                return self.buffer.popleft()
+
+
+# LRUCache is an in-process cache for bytes values, bounded by the total
+#  size of the values it holds rather than by number of entries.
+#  Each worker has its own.
+class LRUCache(object):
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.stats = dict(hits=0, misses=0, evictions=0, expired=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return
+
+        value, expires = entry
+        if expires < time.time():
+            self.delete(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return
+
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def set(self, key, value):
+        self.delete(key)
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (value, time.time() + self.ttl)
+        self.nbytes += size
+
+        while self.nbytes > self.max_bytes:
+            old_key, (old_value, _) = self.entries.popitem(last=False)
+            self.nbytes -= len(old_value)
+            self.stats["evictions"] += 1
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.nbytes -= len(entry[0])
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def info(self):
+        info = dict(self.stats)
+        info.update(
+            entries=len(self.entries),
+            nbytes=self.nbytes,
+            max_bytes=self.max_bytes
+        )
+        return info
+
+
 #  Activities class is only a proxy to underlying data structures.
 #  There are no Activity objects
 class Activities(object):
     name = "activities"
     db = mongodb.get_collection(name)
 
+    # Per-worker cache of msgpack-encoded streams, in front of Redis
+    memory_cache = LRUCache(MEMORY_CACHE_SIZE, MEMORY_CACHE_TTL)
+    toucher = TTLToucher(db)
+
+    # When we change or delete an activity's streams we publish its id
+    #  on hub, and every other worker's uncacher drops its copies from
+    #  their memory_cache (see ACTIVITIES_CHANNEL in config.py).
+    #  Messages are tagged with worker_token so that a worker can skip
+    #  its own.
+    hub = EventHub(ACTIVITIES_CHANNEL, buffer_size=1000)
+    uncacher = None
+    uncacher_pid = None
+    worker_token = None
+
     @classmethod
     def init_db(cls, clear_cache=True):
         # Create/Initialize Activity database
@@ -1464,6 +2662,7 @@ class Activities(object):
             result["mongod_drop"] = str(e)
 
         if clear_cache:
+            cls.memory_cache.clear()
             to_delete = redis.keys(cls.cache_key("*"))
             pipe = redis.pipeline()
             for k in to_delete:
@@ -1510,83 +2709,135 @@ class Activities(object):
 
     @staticmethod
     def bounds(poly):
-        if poly:
-            latlngs = polyline.decode(poly)
-
-            lats = [ll[0] for ll in latlngs]
-            lngs = [ll[1] for ll in latlngs]
-
-            return {
-                "SW": (min(lats), min(lngs)),
-                "NE": (max(lats), max(lngs))
-            }
-        else:
-            return {}
+        return codecs.polyline_bounds(poly)
 
     @staticmethod
     def stream_encode(vals):
-        diffs = [b - a for a, b in zip(vals, vals[1:])]
-        encoded = []
-        pair = None
-        for a, b in zip(diffs, diffs[1:]):
-            if a == b:
-                if pair:
-                    pair[1] += 1
-                else:
-                    pair = [a, 2]
-            else:
-                if pair:
-                    if pair[1] > 2:
-                        encoded.append(pair)
-                    else:
-                        encoded.extend(2 * [pair[0]])
-                    pair = None
-                else:
-                    encoded.append(a)
-        if pair:
-            encoded.append(pair)
-        else:
-            encoded.append(b)
-        return encoded
+        return codecs.rle_encode(vals)
 
     @staticmethod
     def stream_decode(rll_encoded, first_value=0):
-        running_sum = first_value
-        out_list = [first_value]
-
-        for el in rll_encoded:
-            if isinstance(el, list) and len(el) == 2:
-                val, num_repeats = el
-                for i in range(num_repeats):
-                    running_sum += val
-                    out_list.append(running_sum)
-            else:
-                running_sum += el
-                out_list.append(running_sum)
+        return codecs.rle_decode(rll_encoded, first_value).tolist()
 
-        return out_list
+    @staticmethod
+    def cache_key(id, lod=None):
+        if lod is None:
+            return "A:{}".format(id)
+        return "A:{}:{}".format(id, lod)
 
     @staticmethod
-    def cache_key(id):
-        return "A:{}".format(id)
+    def memory_key(id, lod=None):
+        return int(id) if lod is None else (int(id), lod)
 
-    @classmethod
-    def set(cls, _id, data, ttl=TTL_CACHE):
-        # cache it first, in case mongo is down
-        packed = msgpack.packb(data)
-        redis.setex(cls.cache_key(_id), ttl, packed)
+    # Activity summaries with pre-encoded (msgpack) streams attached
+    #  keep them under this key
+    PACKED_STREAMS = "_mpk"
 
-        document = {
-            "ts": datetime.utcnow(),
-            "mpk": Binary(packed)
-        }
-        try:
-            cls.db.update_one(
-                {"_id": int(_id)},
-                {"$set": document},
-                upsert=True)
-        except Exception:
-            log.exception("failed mongodb write: activity %s", id)
+    # Streams are cached at full resolution (None) and at each LOD level
+    LOD_LEVELS = [None] + list(range(len(codecs.LODS)))
+
+    @classmethod
+    def _start_uncacher(cls):
+        # Greenlets don't survive a fork, so we start (or restart) the
+        #  uncacher in the process that uses memory_cache
+        if cls.uncacher_pid != os.getpid():
+            cls.uncacher_pid = os.getpid()
+            cls.worker_token = uuid.uuid4().hex
+            cls.uncacher = gevent.spawn(cls._uncache, cls.hub.subscribe())
+
+    @classmethod
+    def _uncache(cls, sub):
+        while True:
+            message = sub.get()
+            try:
+                token, ids = msgpack.unpackb(message, encoding="utf-8")
+            except Exception:
+                log.exception("bad %s message", cls.hub.channel)
+                continue
+            if token == cls.worker_token:
+                continue
+            for _id in ids:
+                for lod in cls.LOD_LEVELS:
+                    cls.memory_cache.delete(cls.memory_key(_id, lod))
+
+    @classmethod
+    def _publish_changed(cls, ids):
+        # Tell the other workers that streams for ids have changed
+        ids = [int(_id) for _id in ids]
+        if ids:
+            cls.hub.publish(msgpack.packb([cls.worker_token, ids]))
+
+    @classmethod
+    def _cache_locally(cls, _id, wire, lod=None):
+        # Put wire in memory_cache, which we can only do while we are
+        #  listening for changes made by other workers
+        cls._start_uncacher()
+        cls.memory_cache.set(cls.memory_key(_id, lod), wire)
+
+    @classmethod
+    def _uncache_lods(cls, _id, pipe):
+        # Drop cached simplified (LOD) streams for _id, which are
+        #  out of date once we have new streams for it
+        for lod in cls.LOD_LEVELS[1:]:
+            cls.memory_cache.delete(cls.memory_key(_id, lod))
+            pipe.delete(cls.cache_key(_id, lod))
+
+    @staticmethod
+    def decode_streams(packed):
+        # Stream data is stored in MongoDB as a version 2 binary
+        #  container (see codecs.pack_streams) but older records and the
+        #  Redis cache hold msgpack.  Either way we return the stream dict
+        #  that we send to the client.
+        if codecs.is_packed_streams(packed):
+            return codecs.streams_to_wire(packed)
+        return msgpack.unpackb(packed, encoding="utf-8")
+
+    @staticmethod
+    def wire_bytes(packed, lod=None):
+        # msgpack-encoded stream dict, ready to be spliced into an
+        #  outgoing message.  This is what we keep in the Redis cache.
+        #  If lod is given, it is that LOD level (see codecs.LODS) of
+        #  the streams.
+        if lod is not None and not codecs.is_packed_streams(packed):
+            wire = msgpack.unpackb(packed, encoding="utf-8")
+            packed = codecs.wire_to_packed(wire)
+        if codecs.is_packed_streams(packed):
+            return msgpack.packb(codecs.streams_to_wire(packed, lod=lod))
+        return packed
+
+    @staticmethod
+    def wire_field(lod=None):
+        # The MongoDB field holding wire format streams at LOD lod
+        return "wire" if lod is None else "wire{}".format(lod)
+
+    @classmethod
+    def stored_streams(cls, packed, wire, ts):
+        # MongoDB update for new streams.  We keep the version 2
+        #  container (mpk), which LOD levels are made from, and the
+        #  msgpack-encoded stream dict (wire) that we send, so that
+        #  reading streams for the client is only a byte copy.  LOD
+        #  levels are made the first time they are asked for, and
+        #  stored the same way (see _fetch_from_db).
+        return {
+            "$set": {"ts": ts, "mpk": Binary(packed), "wire": Binary(wire)},
+            "$unset": {cls.wire_field(lod): "" for lod in cls.LOD_LEVELS[1:]}
+        }
+
+    @classmethod
+    def set(cls, _id, packed, wire, ttl=TTL_CACHE):
+        # cache it first, in case mongo is down
+        cls._cache_locally(_id, wire)
+        pipe = redis.pipeline()
+        pipe.setex(cls.cache_key(_id), ttl, wire)
+        cls._uncache_lods(_id, pipe)
+        pipe.execute()
+        cls._publish_changed([_id])
+
+        update = cls.stored_streams(packed, wire, datetime.utcnow())
+        try:
+            cls.db.update_one({"_id": int(_id)}, update, upsert=True)
+        except Exception:
+            log.exception("failed mongodb write: activity %s", _id)
 
     @classmethod
     def set_many(cls, batch_queue, ttl=TTL_CACHE):
@@ -1594,23 +2845,23 @@ class Activities(object):
         now = datetime.utcnow()
         redis_pipe = redis.pipeline()
         mongo_batch = []
-        for _id, data in batch_queue:
-            packed = msgpack.packb(data)
-            redis_pipe.setex(cls.cache_key(id), ttl, packed)
-
-            document = {
-                "ts": now,
-                "mpk": Binary(packed)
-            }
-            mongo_batch.append(pymongo.UpdateOne(
-                {"_id": int(_id)},
-                {"$set": document},
-                upsert=True))
+        ids = []
+        for _id, packed, wire in batch_queue:
+            ids.append(_id)
+            cls._cache_locally(_id, wire)
+            redis_pipe.setex(cls.cache_key(_id), ttl, wire)
+            cls._uncache_lods(_id, redis_pipe)
+
+            update = cls.stored_streams(packed, wire, now)
+            mongo_batch.append(
+                pymongo.UpdateOne({"_id": int(_id)}, update, upsert=True)
+            )
         
         if not mongo_batch:
             return
 
         redis_pipe.execute()
+        cls._publish_changed(ids)
 
         try:
             result = cls.db.bulk_write(mongo_batch, ordered=False)
@@ -1619,102 +2870,278 @@ class Activities(object):
             log.exception("Failed mongodb batch write")
 
     @classmethod
-    def get_many(cls, ids, ttl=TTL_CACHE, ordered=False):
-        #  for each id in the ids iterable of activity-ids, this
-        #  generator yields either a dict of streams
-        #  or None if the streams for that activity are not in our
-        #  stores.
-        #  This generator uses batch operations to process the entire
-        #  iterator of ids, so call it in chunks if ids iterator is
-        #  a stream.
-
-        # note we are creating a list from the entire iterable of ids!
-        keys = [cls.cache_key(id) for id in ids]
-    
-        # Attempt to fetch activities with ids from redis cache
-        read_pipe = redis.pipeline()
+    def _expire_many(cls, keys, ttl):
+        # Reset the Redis TTL for keys
+        pipe = redis.pipeline(transaction=False)
         for key in keys:
-            read_pipe.get(key)
-
-        # output and Update TTL for cached actitivities
-        notcached = {}
-        results = read_pipe.execute()
-
-        write_pipe = redis.pipeline()
+            pipe.expire(key, ttl)
+        try:
+            pipe.execute()
+        except Exception:
+            log.exception("Failed redis TTL refresh")
 
-        for id, key, cached in zip(ids, keys, results):
-            if cached:
-                write_pipe.expire(key, ttl)
-                yield (id, msgpack.unpackb(cached, encoding="utf-8"))
+    @classmethod
+    def _fetch_from_db(cls, ids, ttl, lod=None):
+        # Fetch streams for ids from MongoDB and put them in the caches.
+        #  Returns a list of (id, streams).  Streams are stored ready to
+        #  send (see stored_streams), except for LOD levels nobody has
+        #  asked for yet, and records stored before we kept them.  Those
+        #  we make from mpk, and store.
+        field = cls.wire_field(lod)
+        try:
+            docs = list(cls.db.find({"_id": {"$in": ids}}, {field: True}))
+            missing = [doc["_id"] for doc in docs if field not in doc]
+            docs = [doc for doc in docs if field in doc]
+            if missing:
+                docs += list(cls.db.find(
+                    {"_id": {"$in": missing}},
+                    {"mpk": True, "ts": True}
+                ))
+        except Exception:
+            log.exception("Failed mongodb query for %s ids", len(ids))
+            return []
+
+        # converting the rest to wire format is CPU work, so we do it
+        #  all at once, off the event loop
+        results = []
+        made_from = {}
+        for doc in docs:
+            if field in doc:
+                results.append((int(doc["_id"]), doc[field], None))
             else:
-                notcached[int(id)] = key
-        
-        # Batch update TTL for redis cached activity streams
-        # write_pipe.execute()
-        fetched = set()
-        if notcached:
-            # Attempt to fetch uncached activities from MongoDB
+                result = cpu_pool.submit(cls.wire_bytes, doc["mpk"], lod)
+                results.append((int(doc["_id"]), None, result))
+                made_from[int(doc["_id"])] = doc.get("ts")
+
+        found = []
+        backfill = []
+        pipe = redis.pipeline(transaction=False)
+        for _id, wire, result in results:
+            if result:
+                try:
+                    wire = result.get()
+                except Exception:
+                    log.exception("bad stream data for activity %s", _id)
+                    continue
+                # to be stored, unless the streams change in the
+                #  meantime (which resets ts)
+                backfill.append(pymongo.UpdateOne(
+                    {"_id": _id, "ts": made_from[_id]},
+                    {"$set": {field: Binary(wire)}}
+                ))
+            pipe.setex(cls.cache_key(_id, lod), ttl, wire)
+            cls._cache_locally(_id, wire, lod)
+            found.append((_id, wire))
+
+        if found:
             try:
-                query = {"_id": {"$in": list(notcached.keys())}}
-                results = cls.db.find(query)
+                pipe.execute()
             except Exception:
-                log.exception("Failed mongodb query: %s", query)
-                return
+                log.exception("Failed redis batch write")
 
-            # iterate through results from MongoDB query
-            for doc in results:
-                id = int(doc["_id"])
-                packed = doc["mpk"]
+            # store what we made, so we only make it once
+            if backfill:
+                try:
+                    cls.db.bulk_write(backfill, ordered=False)
+                except Exception:
+                    log.exception("Failed mongodb batch write")
 
-                # Store in redis cache
-                write_pipe.setex(notcached[id], ttl, packed)
-                fetched.add(id)
+            # update TTL for mongoDB records
+            cls.toucher.touch(_id for _id, wire in found)
+        return found
 
-                yield (id, msgpack.unpackb(packed, encoding="utf-8"))
+    @classmethod
+    def get_many(
+        cls,
+        ids,
+        ttl=TTL_CACHE,
+        chunk_size=CACHE_CHUNK_SIZE,
+        lod=None
+    ):
+        #  for each id in the ids iterable of activity-ids, this
+        #  generator yields (id, streams) where streams is the
+        #  msgpack-encoded dict of streams (see wire_bytes), for
+        #  activities whose streams are in our stores.
+        #  Results are not in any particular order.
+        #  Each LOD level is cached separately.
+        #
+        #  ids are consumed chunk_size at a time: one MGET per chunk.
+        #  Ids that are not in Redis are looked up in MongoDB in the
+        #  background while we go on with the next chunk.  Cache
+        #  TTL refreshes are also done in the background, so they happen
+        #  even if the consumer of this generator quits early.
+        pending = []
+
+        def finished_db_fetches(wait=False):
+            for g in list(pending):
+                if wait:
+                    g.join()
+                if g.ready():
+                    pending.remove(g)
+                    for result in (g.value or []):
+                        yield result
+
+        for chunk in Utility.chunks(ids, size=chunk_size):
+            # First we check the in-process cache
+            misses = []
+            for id in chunk:
+                wire = cls.memory_cache.get(cls.memory_key(id, lod))
+                if wire:
+                    yield (id, wire)
+                else:
+                    misses.append(id)
 
-        # All fetched streams have been sent to the client
-        # now we update the data-stores
-        write_pipe.execute()
+            if misses:
+                keys = [cls.cache_key(id, lod) for id in misses]
+                try:
+                    results = redis.mget(keys)
+                except Exception:
+                    log.exception("Failed redis mget")
+                    results = [None] * len(keys)
+
+                cached_keys = []
+                notcached = []
+                for id, key, cached in zip(misses, keys, results):
+                    if cached:
+                        cached_keys.append(key)
+                        wire = cls.wire_bytes(cached)
+                        cls._cache_locally(id, wire, lod)
+                        yield (id, wire)
+                    else:
+                        notcached.append(int(id))
 
-        if fetched:
-            # now update TTL for mongoDB records if there were any
-            now = datetime.utcnow()
-            try:
-                cls.db.update_many(
-                    {"_id": {"$in": list(fetched)}},
-                    {"$set": {"ts": now}}
-                )
-            except Exception:
-                log.exception("Failed mongoDB update_many")
+                if cached_keys:
+                    gevent.spawn(cls._expire_many, cached_keys, ttl)
+
+                if notcached:
+                    pending.append(gevent.spawn(
+                        cls._fetch_from_db, notcached, ttl, lod
+                    ))
+
+            for result in finished_db_fetches():
+                yield result
+
+        for result in finished_db_fetches(wait=True):
+            yield result
 
     @classmethod
     def get(cls, _id, ttl=TTL_CACHE):
-        packed = None
-        key = cls.cache_key(id)
+        packed = cls.memory_cache.get(int(_id))
+        if packed:
+            return cls.decode_streams(packed)
+
+        key = cls.cache_key(_id)
         cached = redis.get(key)
 
         if cached:
             redis.expire(key, ttl)  # reset expiration timeout
-            packed = cached
+            packed = cls.wire_bytes(cached)
         else:
+            found = cls._fetch_from_db([int(_id)], ttl)
+            if found:
+                packed = found[0][1]
+        if packed:
+            cls._cache_locally(_id, packed)
+            return cls.decode_streams(packed)
+
+    @classmethod
+    def delete(cls, _id):
+        # Remove streams for activity _id (at every LOD) from all of
+        #  our stores
+        for lod in cls.LOD_LEVELS:
+            cls.memory_cache.delete(cls.memory_key(_id, lod))
+        redis.delete(*[cls.cache_key(_id, lod) for lod in cls.LOD_LEVELS])
+        cls._publish_changed([_id])
+        try:
+            return cls.db.delete_one({"_id": int(_id)})
+        except Exception:
+            log.exception("error deleting activity %s streams", _id)
+
+    @classmethod
+    def migrate_streams(cls, batch_size=500):
+        # Re-encode any stream records stored in the old msgpack format
+        #  as version 2 containers, and store the wire format streams
+        #  for records that don't have them.  Records we don't get to
+        #  will just expire (TTL_DB).
+        stats = dict(n=0, migrated=0, err=0)
+        timer = Timer()
+
+        def flush(batch):
             try:
-                document = cls.db.find_one_and_update(
-                    {"_id": int(_id)},
-                    {"$set": {"ts": datetime.utcnow()}}
-                )
+                cls.db.bulk_write(batch, ordered=False)
+            except Exception:
+                log.exception("Failed mongodb batch write")
+                stats["err"] += len(batch)
+            else:
+                stats["migrated"] += len(batch)
 
+        batch = []
+        for doc in cls.db.find({"wire": {"$exists": False}}, {"mpk": True}):
+            stats["n"] += 1
+            packed = doc.get("mpk")
+            if not packed:
+                continue
+
+            try:
+                if codecs.is_packed_streams(packed):
+                    update = {"wire": Binary(cls.wire_bytes(packed))}
+                else:
+                    # old records are already in wire format
+                    wire = msgpack.unpackb(packed, encoding="utf-8")
+                    update = {
+                        "mpk": Binary(codecs.wire_to_packed(wire)),
+                        "wire": Binary(packed)
+                    }
             except Exception:
-                log.debug("Failed mongodb find_one_and_update %s", _id)
-                return
+                log.exception("failed to migrate activity %s", doc["_id"])
+                stats["err"] += 1
+                continue
 
-            if document:
-                packed = document["mpk"]
-                redis.setex(key, ttl, packed)
-        if packed:
-            return msgpack.unpackb(packed, encoding="utf-8")
+            batch.append(pymongo.UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": update}
+            ))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+
+        if batch:
+            flush(batch)
+
+        stats["dt"] = timer.elapsed()
+        msg = "{} stream migration {}".format(cls.name, stats)
+        log.info(msg)
+        EventLogger.new_event(msg=msg)
+        return stats
 
     @classmethod
-    def import_streams(cls, client, activity, batch_queue=None):
+    def encode_streams(cls, streams, lod=None):
+        # Encode streams as we get them from Strava (lists of values).
+        #  Returns the stream dict for the client (polyline, RLE encoded
+        #  streams, n), the bounds of the activity, and what we store
+        #  (packed) and cache (wire).  If lod is given, the stream dict
+        #  is only that level of detail (we still store it all).
+        streams = dict(streams)
+        latlngs = streams.pop("latlng")
+
+        # Encode/compress latlng data into polyline format, getting
+        #  the (full resolution) bounding box along the way
+        encoded_streams = {}
+        encoded_streams["polyline"], bounds = codecs.polyline_encode(latlngs)
+        encoded_streams["n"] = len(latlngs)
+        for name, stream in streams.items():
+            encoded_streams[name] = cls.stream_encode(stream)
+
+        # This is what we store in MongoDB, and cache in Redis
+        packed = codecs.pack_streams(latlngs, **streams)
+        wire = msgpack.packb(encoded_streams)
+
+        if lod is not None:
+            encoded_streams = codecs.streams_to_wire(packed, lod=lod)
+        return encoded_streams, bounds, packed, wire
+
+    @classmethod
+    def import_streams(cls, client, activity, batch_queue=None, lod=None):
         if OFFLINE:
             return
         if "_id" not in activity:
@@ -1736,40 +3163,29 @@ class Activities(object):
             # a result of False means there was an error
             return result
 
-        encoded_streams = {}
-
         try:
-            # Encode/compress latlng data into polyline format
-            p = result.pop("latlng")
-            encoded_streams["polyline"] = polyline.encode(p)
-            encoded_streams["n"] = len(p)
+            encoded_streams, bounds, packed, wire = cpu_pool.run(
+                cls.encode_streams, result, lod
+            )
         except Exception:
-            log.exception("failed polyline encode for activity %s", _id)
+            log.exception("failed encoding streams for activity %s", _id)
             return False
-
-        for name, stream in result.items():
-            # Encode/compress these streams
-            try:
-                encoded_streams[name] = cls.stream_encode(stream)
-            except Exception:
-                log.exception(
-                    "failed RLE encoding stream '%s' for activity %s",
-                    name, _id)
-                return False
      
         if batch_queue:
-            batch_queue.put((_id, encoded_streams))
+            batch_queue.put((_id, packed, wire))
         else:
-            cls.set(_id, encoded_streams)
-        
+            cls.set(_id, packed, wire)
+            Tiles.invalidate(client.user.id)
+
         activity.update(encoded_streams)
+        activity["bounds"] = bounds
 
         # elapsed = round(time.time() - start, 2)
         # log.debug("%s imported %s: elapsed=%s", client, _id, elapsed)
         return activity
 
     @classmethod
-    def append_streams_from_db(cls, summaries):
+    def append_streams_from_db(cls, summaries, lod=None):
         # adds actvity streams to an iterable of summaries
         #  summaries must be manageable by a single batch operation
         to_fetch = {}
@@ -1783,13 +3199,14 @@ class Activities(object):
             return
 
         # yield stream-appended summaries that we were able to
-        #  fetch streams for
-        for _id, stream_data in cls.get_many(list(to_fetch.keys())):
+        #  fetch streams for.  The streams stay msgpack-encoded
+        #  until they are sent.
+        for _id, stream_data in cls.get_many(list(to_fetch.keys()), lod=lod):
             if not stream_data:
                 continue
                 
             A = to_fetch.pop(_id)
-            A.update(stream_data)
+            A[cls.PACKED_STREAMS] = stream_data
             yield A
 
         # now we yield the rest of the summaries
@@ -1797,30 +3214,387 @@ class Activities(object):
             yield A
 
     @classmethod
-    def query(cls, queryObj):
-        for user_id in queryObj:
-            user = Users.get(user_id)
-            if not user:
-                continue
+    def query(cls, queryObj, cursor_id=None):
+        # With a cursor_id (see QueryCursors) we keep track of what we
+        #  have sent, so that the query can be resumed if we lose
+        #  the client.  The client gets the cursor_id first.
+        sent = []
+
+        def on_sent(_id):
+            sent.append(_id)
+            if len(sent) >= QueryCursors.FLUSH_SIZE:
+                QueryCursors.add_sent(cursor_id, sent)
+                del sent[:]
+
+        if cursor_id:
+            yield {"cursor": cursor_id}
+
+        done = False
+        try:
+            for user_id in queryObj:
+                user = Users.get(user_id)
+                if not user:
+                    continue
 
-            query = queryObj[user_id]
-            activities = user.query_activities(**query)
+                query = queryObj[user_id]
+                activities = user.query_activities(
+                    on_sent=on_sent if cursor_id else None,
+                    **query
+                )
 
-            if activities:
-                for a in activities:
+                if activities:
+                    for a in activities:
+
+                        abort_signal = yield a
+                        
+                        if abort_signal:
+                            activities.send(abort_signal)
+                            done = True
+                            return
+            done = True
+
+        finally:
+            # If we didn't finish, we were abandoned (the connection
+            #  dropped) and the client may resume
+            if cursor_id and done:
+                QueryCursors.finish(cursor_id)
+            elif cursor_id and sent:
+                QueryCursors.add_sent(cursor_id, sent)
 
-                    abort_signal = yield a
-                    
-                    if abort_signal:
-                        activities.send(abort_signal)
-                        return
-        
         yield ""
         
 
+# A websocket query can be resumed by a client that lost its connection
+#  part way through, without starting it over.  For each query we keep
+#  the query itself and the ids of activities we have sent for it in
+#  Redis, for TTL_QUERY_CURSOR seconds after the last one we sent.
+#  Resuming runs the query again, excluding those activities in the
+#  Index query, so we don't fetch or import their streams again.
+class QueryCursors(object):
+    FLUSH_SIZE = 20
+
+    @staticmethod
+    def query_key(cursor_id):
+        return "QC:{}".format(cursor_id)
+
+    @staticmethod
+    def sent_key(cursor_id):
+        return "QC:{}:sent".format(cursor_id)
+
+    @classmethod
+    def create(cls, queryObj, ttl=TTL_QUERY_CURSOR):
+        cursor_id = uuid.uuid4().hex
+        try:
+            redis.setex(cls.query_key(cursor_id), ttl, json.dumps(queryObj))
+        except Exception:
+            log.exception("error creating query cursor")
+            return
+        return cursor_id
+
+    @classmethod
+    def add_sent(cls, cursor_id, ids, ttl=TTL_QUERY_CURSOR):
+        pipe = redis.pipeline(transaction=False)
+        pipe.sadd(cls.sent_key(cursor_id), *ids)
+        pipe.expire(cls.sent_key(cursor_id), ttl)
+        pipe.expire(cls.query_key(cursor_id), ttl)
+        try:
+            pipe.execute()
+        except Exception:
+            log.exception("error updating query cursor %s", cursor_id)
+
+    @classmethod
+    def finish(cls, cursor_id):
+        try:
+            redis.delete(cls.query_key(cursor_id), cls.sent_key(cursor_id))
+        except Exception:
+            log.exception("error deleting query cursor %s", cursor_id)
+
+    @classmethod
+    def resume(cls, cursor_id, have_digest=None):
+        # The query for what is left of cursor_id, or None if it has
+        #  expired.  We may have sent activities that the client didn't
+        #  get before the connection dropped, so if it tells us what it
+        #  has (as a digest, like exclude_digest) we only leave out
+        #  activities it has.
+        pipe = redis.pipeline(transaction=False)
+        pipe.get(cls.query_key(cursor_id))
+        pipe.smembers(cls.sent_key(cursor_id))
+        try:
+            queryObj, sent = pipe.execute()
+        except Exception:
+            log.exception("error reading query cursor %s", cursor_id)
+            return
+        if not queryObj:
+            return
+
+        queryObj = json.loads(queryObj)
+        sent = set(int(_id) for _id in sent)
+        have = None
+        if have_digest is not None:
+            have = set(codecs.id_digest_decode(have_digest).tolist())
+
+        for query in queryObj.values():
+            exclude = set(int(_id) for _id in query.pop("exclude_ids", []))
+            digest = query.pop("exclude_digest", None)
+            if digest:
+                exclude.update(codecs.id_digest_decode(digest).tolist())
+            exclude.update(sent)
+            if have is not None:
+                exclude &= have
+            if exclude:
+                query["exclude_ids"] = list(exclude)
+        return queryObj
+
+
+# Aggregate stats of each user's indexed activities: number of activities
+#  (in total and by type), total distance and elapsed time, first and last
+#  (local) start times, and the bounding box of all of them.  They are
+#  kept up to date with $inc/$min/$max as activities are added to the
+#  index.  Deleting or changing activities marks a user's stats as stale,
+#  and stale or old (USER_STATS_MAX_AGE) stats are recomputed from the
+#  index the next time they are asked for.
+class UserStats(object):
+    name = "user_stats"
+    db = mongodb.get_collection(name)
+
+    @classmethod
+    def init_db(cls):
+        try:
+            mongodb.drop_collection(cls.name)
+            mongodb.create_collection(cls.name)
+            cls.db.create_index(
+                "ts",
+                name="ts",
+                expireAfterSeconds=TTL_INDEX
+            )
+        except Exception:
+            log.exception(
+                "MongoDB error initializing %s collection",
+                cls.name
+            )
+        log.info("initialized '%s' collection:", cls.name)
+
+    @staticmethod
+    def _updates(docs):
+        # $inc/$min/$max updates for each user, from index entries
+        updates = {}
+        for d in docs:
+            u = updates.setdefault(
+                d["user_id"],
+                {"$inc": {}, "$min": {}, "$max": {}}
+            )
+            inc, lo, hi = u["$inc"], u["$min"], u["$max"]
+
+            def add(field, val):
+                inc[field] = inc.get(field, 0) + val
+
+            def low(field, val):
+                if field not in lo or val < lo[field]:
+                    lo[field] = val
+
+            def high(field, val):
+                if field not in hi or val > hi[field]:
+                    hi[field] = val
+
+            add("count", 1)
+            add("types.{}".format(d.get("type")), 1)
+            add("distance", d.get("total_distance") or 0)
+            add("elapsed_time", d.get("elapsed_time") or 0)
+
+            ts = d.get("ts_local")
+            if ts:
+                low("first", ts)
+                high("last", ts)
+
+            bounds = d.get("bounds")
+            if bounds:
+                low("S", bounds["SW"][0])
+                low("W", bounds["SW"][1])
+                high("N", bounds["NE"][0])
+                high("E", bounds["NE"][1])
+        return updates
+
+    @classmethod
+    def add(cls, docs):
+        # Add new index entries to their users' stats.  We only update
+        #  stats that are already there; partial stats for a user with
+        #  none would look complete, so those are left for get() to
+        #  compute from the whole index.
+        for user_id, update in cls._updates(docs).items():
+            update = {op: fields for op, fields in update.items() if fields}
+            try:
+                cls.db.update_one({"_id": user_id}, update)
+            except Exception:
+                log.exception("error updating stats for user %s", user_id)
+
+    @classmethod
+    def mark_stale(cls, user_id):
+        try:
+            cls.db.update_one({"_id": user_id}, {"$set": {"stale": True}})
+        except Exception:
+            log.exception("error updating stats for user %s", user_id)
+
+    @classmethod
+    def clear(cls, user_id):
+        try:
+            cls.db.delete_one({"_id": user_id})
+        except Exception:
+            log.exception("error deleting stats for user %s", user_id)
+
+    @classmethod
+    def recompute(cls, user_id):
+        # Compute a user's stats from scratch, from their index entries
+        pipeline = [
+            {"$match": {"user_id": user_id}},
+            {"$group": {
+                "_id": "$type",
+                "count": {"$sum": 1},
+                "distance": {"$sum": "$total_distance"},
+                "elapsed_time": {"$sum": "$elapsed_time"},
+                "first": {"$min": "$ts_local"},
+                "last": {"$max": "$ts_local"},
+                "S": {"$min": {"$arrayElemAt": ["$bounds.SW", 0]}},
+                "W": {"$min": {"$arrayElemAt": ["$bounds.SW", 1]}},
+                "N": {"$max": {"$arrayElemAt": ["$bounds.NE", 0]}},
+                "E": {"$max": {"$arrayElemAt": ["$bounds.NE", 1]}},
+            }}
+        ]
+        try:
+            by_type = list(Index.db.aggregate(pipeline))
+        except Exception:
+            log.exception("error computing stats for user %s", user_id)
+            return
+
+        if not by_type:
+            cls.clear(user_id)
+            return
+
+        stats = dict(
+            _id=user_id,
+            count=sum(t["count"] for t in by_type),
+            types={str(t["_id"]): t["count"] for t in by_type},
+            distance=sum(t["distance"] for t in by_type),
+            elapsed_time=sum(t["elapsed_time"] for t in by_type),
+            ts=datetime.utcnow()
+        )
+        for field, pick in [("first", min), ("last", max), ("S", min),
+                            ("W", min), ("N", max), ("E", max)]:
+            vals = [t[field] for t in by_type if t[field] is not None]
+            if vals:
+                stats[field] = pick(vals)
+
+        try:
+            cls.db.replace_one({"_id": user_id}, stats, upsert=True)
+        except Exception:
+            log.exception("error storing stats for user %s", user_id)
+        return stats
+
+    @classmethod
+    def get(cls, user_id):
+        # A user's stats, or None if they have no index.  Bounds are
+        #  given as "bounds": {"SW": (S, W), "NE": (N, E)}
+        try:
+            stats = cls.db.find_one({"_id": user_id})
+        except Exception:
+            log.exception("error getting stats for user %s", user_id)
+            return
+
+        if stats:
+            age = (datetime.utcnow() - stats["ts"]).total_seconds()
+        if (not stats) or stats.get("stale") or (age > USER_STATS_MAX_AGE):
+            stats = cls.recompute(user_id)
+            if not stats:
+                return
+
+        if "S" in stats:
+            stats["bounds"] = {
+                "SW": (stats.pop("S"), stats.pop("W")),
+                "NE": (stats.pop("N"), stats.pop("E"))
+            }
+        stats.pop("stale", None)
+        return stats
+
+
+# Heatmap tiles of a user's activities, rendered (see tiles.py) from
+#  the stream data we have for the activities in their index, and
+#  cached in Redis.  Tile cache keys include a per-user version number
+#  that goes up whenever activities are added to or removed from
+#  the user's index, so outdated tiles are never served.
+class Tiles(object):
+
+    @staticmethod
+    def version_key(user_id):
+        return "TV:{}".format(user_id)
+
+    @classmethod
+    def version(cls, user_id):
+        version = redis.get(cls.version_key(user_id))
+        return int(version) if version else 0
+
+    @classmethod
+    def invalidate(cls, user_id):
+        try:
+            redis.incr(cls.version_key(user_id))
+        except Exception:
+            log.exception("error invalidating tiles for user %s", user_id)
+
+    @staticmethod
+    def cache_key(user_id, version, z, x, y):
+        return "T:{}:{}:{}:{}:{}".format(user_id, version, z, x, y)
+
+    @staticmethod
+    def render(wires, z, x, y):
+        # PNG tile from msgpack-encoded stream dicts
+        tracks = (
+            codecs.polyline_decode(
+                msgpack.unpackb(wire, encoding="utf-8")["polyline"]
+            )
+            for wire in wires
+        )
+        return tiles.render_tile(tracks, z, x, y)
+
+    @classmethod
+    def get(cls, user, z, x, y, ttl=TTL_TILES):
+        # PNG image (bytes) for tile x, y at zoom z
+        key = cls.cache_key(user.id, cls.version(user.id), z, x, y)
+        png = redis.get(key)
+        if png:
+            return png
+
+        timer = Timer()
+        sw, ne = tiles.tile_bounds(z, x, y)
+        try:
+            query = dict(Index.box_query(sw, ne), user_id=user.id)
+            ids = [doc["_id"] for doc in Index.db.find(query, {"_id": True})]
+        except Exception:
+            log.exception("error getting activities for tile %s", key)
+            ids = []
+
+        # The LOD level for this zoom looks the same as the
+        #  full-resolution track at this zoom and is much cheaper
+        lod = codecs.lod_for_zoom(z)
+
+        wires = [wire for _id, wire in Activities.get_many(ids, lod=lod)]
+        png = cpu_pool.run(cls.render, wires, z, x, y)
+        redis.setex(key, ttl, png)
+        log.debug("%s rendered tile %s: n=%s, dt=%s",
+                  user, key, len(ids), timer.elapsed())
+        return png
+
+
 class EventLogger(object):
     name = "history"
     db = mongodb.get_collection(name)
+    hub = EventHub(EVENTS_CHANNEL, EVENTS_BUFFER_SIZE)
+
+    # Events waiting to be written to MongoDB and published to the hub.
+    #  new_event never waits for either: writes happen in batches on a
+    #  background greenlet (see flush), and publishing on another.
+    pending = []
+    unpublished = []
+    flusher = None
+    publisher = None
+    stats = dict(logged=0, written=0, batches=0, overflow=0, errors=0)
 
     @classmethod
     def init_db(cls, rebuild=True, size=app.config["MAX_HISTORY_BYTES"]):
@@ -1850,12 +3624,14 @@ class EventLogger(object):
 
     @classmethod
     def get_event(cls, event_id):
+        cls.flush()
         event = cls.db.find_one({"_id": ObjectId(event_id)})
         event["_id"] = str(event["_id"])
         return event
 
     @classmethod
     def get_log(cls, limit=0):
+        cls.flush()
         events = list(
             cls.db.find(
                 sort=[("$natural", pymongo.DESCENDING)]).limit(limit)
@@ -1865,31 +3641,54 @@ class EventLogger(object):
             e["ts"] = Utility.to_epoch(e["ts"])
         return events
 
+    @staticmethod
+    def _export(event):
+        # an event as we send it to clients
+        return dict(
+            event,
+            _id=str(event["_id"]),
+            ts=Utility.to_epoch(event["ts"])
+        )
+
     @classmethod
-    def live_updates_gen(cls, ts=None):
-        def gen(ts):
-            abort_signal = None
-            while not abort_signal:
-                cursor = cls.db.find(
-                    {'ts': {'$gt': ts}},
-                    cursor_type=pymongo.CursorType.TAILABLE_AWAIT
-                )
+    def live_updates_gen(cls, ts=None, closed=None):
+        # Yields events logged since ts, then new events as they are
+        #  logged (from cls.hub) until it is sent an abort signal or
+        #  closed() is True.  New events are yielded msgpack-encoded.
+        def gen(ts, sub):
+            try:
+                # We subscribe before reading the log so that we don't
+                #  miss anything in between, and skip events we have
+                #  already sent.  Events still waiting to be written
+                #  may have been published before we subscribed, so
+                #  they have to be in the log before we read it.
+                cls.flush()
+                sent = set()
+                for doc in cls.db.find({'ts': {'$gt': ts}}):
+                    doc = cls._export(doc)
+                    sent.add(doc["_id"])
+                    abort_signal = yield doc
+                    if abort_signal:
+                        log.info("live-updates aborted")
+                        return
 
-                while cursor.alive and not abort_signal:
-                    for doc in cursor:
-                        doc["ts"] = Utility.to_epoch(doc["ts"])
-                        doc["_id"] = str(doc["_id"])
+                while not (closed and closed()):
+                    message = sub.get(timeout=5)
+                    if message is None:
+                        continue
 
-                        abort_signal = yield doc
-                        if abort_signal:
-                            log.info("live-updates aborted")
-                            return
+                    if sent:
+                        event = msgpack.unpackb(message, encoding="utf-8")
+                        if event["_id"] in sent:
+                            continue
+                        sent = None
 
-                    # We end up here if the find() returned no
-                    # documents or if the tailable cursor timed out
-                    # (no new documents were added to the
-                    # collection for more than 1 second)
-                    gevent.sleep(2)
+                    abort_signal = yield message
+                    if abort_signal:
+                        log.info("live-updates aborted")
+                        return
+            finally:
+                cls.hub.unsubscribe(sub)
 
         if not ts:
             first = cls.db.find().sort(
@@ -1899,15 +3698,83 @@ class EventLogger(object):
 
             ts = first['ts']
 
-        return gen(ts)
+        return gen(ts, cls.hub.subscribe())
 
     @classmethod
     def new_event(cls, **event):
+        if len(cls.pending) >= EVENTS_MAX_PENDING:
+            cls.stats["overflow"] += 1
+            return
+
         event["ts"] = datetime.utcnow()
+        event["_id"] = ObjectId()
+        cls.pending.append(event)
+        cls.unpublished.append(event)
+        cls.stats["logged"] += 1
+
+        if not cls.publisher:
+            cls.publisher = gevent.spawn(cls._publish)
+
+        if len(cls.pending) >= EVENTS_FLUSH_SIZE:
+            gevent.spawn(cls.flush)
+        elif not cls.flusher:
+            cls.flusher = gevent.spawn_later(EVENTS_FLUSH_INTERVAL, cls._flush)
+
+    @classmethod
+    def _publish(cls):
+        cls.publisher = None
+        events, cls.unpublished = cls.unpublished, []
+        messages = []
+        for event in events:
+            try:
+                messages.append(msgpack.packb(cls._export(event), default=str))
+            except Exception:
+                log.exception("error encoding event %s", event)
+        if messages:
+            cls.hub.publish(*messages)
+
+    @classmethod
+    def _flush(cls):
+        cls.flusher = None
+        cls.flush()
+
+    @classmethod
+    def flush(cls):
+        # Write pending events to MongoDB
+        events, cls.pending = cls.pending, []
+        if not events:
+            return
         try:
-            cls.db.insert_one(event)
-        except Exception:
-            log.exception("error inserting event %s", event)
+            cls.db.insert_many(events, ordered=False)
+        except Exception as e:
+            # Put back the ones that weren't written (ahead of any logged
+            #  since) to try again later.  Events already in the log from
+            #  an earlier try fail as duplicates, and are not put back.
+            #  Whatever doesn't fit within EVENTS_MAX_PENDING is dropped,
+            #  oldest first.
+            log.exception("error inserting %s events", len(events))
+            cls.stats["errors"] += 1
+            if isinstance(e, pymongo.errors.BulkWriteError):
+                failed = set(
+                    err["index"] for err in e.details["writeErrors"]
+                    if err["code"] != 11000
+                )
+                events = [events[i] for i in sorted(failed)]
+            cls.pending = events + cls.pending
+            excess = len(cls.pending) - EVENTS_MAX_PENDING
+            if excess > 0:
+                cls.stats["overflow"] += excess
+                del cls.pending[:excess]
+            if not cls.flusher:
+                cls.flusher = gevent.spawn_later(
+                    EVENTS_FLUSH_INTERVAL, cls._flush)
+        else:
+            cls.stats["written"] += len(events)
+            cls.stats["batches"] += 1
+
+    @classmethod
+    def info(cls):
+        return dict(cls.stats, pending=len(cls.pending))
 
     @classmethod
     def log_request(cls, flask_request_object, **args):
@@ -1919,6 +3786,10 @@ class EventLogger(object):
         cls.new_event(**args)
 
 
+# Don't lose logged events when the worker shuts down
+atexit.register(EventLogger.flush)
+
+
 class Webhooks(object):
     name = "subscription"
 
@@ -2044,8 +3915,9 @@ class Webhooks(object):
                 log.info("webhook: %s create %s failed", user, _id)
 
         elif update.aspect_type == "delete":
-            # delete the activity from the index
+            # delete the activity from the index, and its streams
             Index.delete(_id)
+            Activities.delete(_id)
 
     @staticmethod
     def iter_updates(limit=0):
@@ -2179,6 +4051,46 @@ class Utility():
             map(tuple, starmap(islice, repeat((iter(iterable), size))))
         )
 
+    @staticmethod
+    def bounds_intersect(bounds, viewport):
+        # True if bounds ({"SW": (lat, lng), "NE": (lat, lng)}) overlaps
+        #  viewport ([[south, west], [north, east]]), the same way
+        #  Index.box_query decides it
+        try:
+            (s, w), (n, e) = bounds["SW"], bounds["NE"]
+            vs, vn, lngs = Index.box_area(*viewport)
+        except Exception:
+            return False
+        if not ((s <= vn) and (vs <= n)):
+            return False
+        return lngs is None or any((w <= ve) and (vw <= e) for vw, ve in lngs)
+
+    @staticmethod
+    def timed_chunks(queue, size=10, timeout=0.05):
+        # Like chunks, but reads from a gevent queue (that ends with
+        #  StopIteration) and yields a chunk as soon as it has size
+        #  items or timeout seconds after its first item arrived,
+        #  whichever comes first.
+        while True:
+            item = queue.get()
+            if item is StopIteration:
+                return
+            chunk = [item]
+            deadline = time.time() + timeout
+            while len(chunk) < size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = queue.get(timeout=remaining)
+                except gevent.queue.Empty:
+                    break
+                if item is StopIteration:
+                    yield chunk
+                    return
+                chunk.append(item)
+            yield chunk
+
 
 # FakeQueue is a a queue that does nothing.  We use this for import queue if
 #  the user is offline or does not have a valid access token
@@ -2187,6 +4099,101 @@ class FakeQueue(object):
         return
 
 
+# KeyedPriorityQueue is a gevent PriorityQueue that takes plain items and
+#  orders them by key(item), lowest first.  Items with the same key come
+#  out in the order they went in.
+class KeyedPriorityQueue(gevent.queue.PriorityQueue):
+    def __init__(self, key, maxsize=None):
+        self.key = key
+        self.count = itertools.count()
+        super(KeyedPriorityQueue, self).__init__(maxsize)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self.key(item), next(self.count), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[-1]
+
+    def _peek(self):
+        return self.queue[0][-1]
+
+
+class BulkWriter(object):
+    # Writes MongoDB requests to a collection in batches, on a background
+    #  greenlet, while the caller keeps producing requests.
+    #  A batch is sent when it has batch_size requests or batch_bytes
+    #  (approximate) bytes.  put() blocks while max_pending batches are
+    #  waiting to be written, so memory use stays bounded no matter how
+    #  many requests there are.
+    def __init__(
+        self,
+        collection,
+        batch_size=INDEX_WRITE_BATCH_SIZE,
+        batch_bytes=INDEX_WRITE_BATCH_BYTES,
+        max_pending=INDEX_WRITE_MAX_PENDING,
+        on_written=None
+    ):
+        # on_written(items, result) is called after each batch is
+        #  written, with the items given to put() for that batch
+        #  and the BulkWriteResult
+        self.collection = collection
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.on_written = on_written
+        self.batch = []
+        self.items = []
+        self.batch_size_bytes = 0
+        self.closed = False
+        self.queue = gevent.queue.Queue(maxsize=max_pending)
+        self.stats = dict(queued=0, written=0, batches=0, errors=0, dt=0)
+        self.writer = gevent.spawn(self._write_batches)
+
+    def put(self, request, size=0, item=None):
+        self.batch.append(request)
+        self.items.append(item)
+        self.batch_size_bytes += size
+        self.stats["queued"] += 1
+        if ((len(self.batch) >= self.batch_size) or
+                (self.batch_size_bytes >= self.batch_bytes)):
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.queue.put((self.batch, self.items))
+            self.batch = []
+            self.items = []
+            self.batch_size_bytes = 0
+
+    def _write_batches(self):
+        for batch, items in self.queue:
+            timer = Timer()
+            try:
+                result = self.collection.bulk_write(batch, ordered=False)
+                if self.on_written:
+                    self.on_written(items, result)
+            except Exception:
+                log.exception(
+                    "error writing %s requests to %s",
+                    len(batch),
+                    self.collection.name
+                )
+                self.stats["errors"] += len(batch)
+            else:
+                self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["dt"] += timer.elapsed()
+
+    def close(self):
+        # Write whatever is left and wait for it to be written
+        if self.closed:
+            return self.stats
+        self.closed = True
+        self.flush()
+        self.queue.put(StopIteration)
+        self.writer.join()
+        return self.stats
+
+
 class Timer(object):
     
     def __init__(self):
@@ -2199,11 +4206,29 @@ class Timer(object):
 class BinaryWebsocketClient(object):
     # WebsocketClient is a wrapper for a websocket
     #  It attempts to gracefully handle broken connections
+
+    # Framing options a client can ask for (see set_options)
+    #  batch: frames may be msgpack arrays of several messages
+    #  deflate: each frame starts with a flag byte, and if it is 1
+    #    the rest of the frame is zlib-compressed
+    #  credit: flow control.  The value is how many bytes (of frames) we
+    #    may send before the client grants us more with {"credit": n}
+    FEATURES = ["batch", "deflate", "credit"]
+
     def __init__(self, websocket, ttl=60 * 60 * 24):
         self.ws = websocket
         self.birthday = time.time()
         self.gen = None
 
+        self.options = {}
+        self.batch = []
+        self.batch_bytes = 0
+        self.batch_flusher = None
+        self.send_lock = gevent.lock.RLock()
+        self.credit = None
+        self.credit_ready = gevent.event.Event()
+        self.stats = dict(msgs=0, frames=0, bytes=0, stalls=0, stalled=0)
+
         # this is a the client_id for the web-page
         # accessing this websocket
         self.client_id = None
@@ -2226,13 +4251,18 @@ class BinaryWebsocketClient(object):
         return self.ws.closed
 
     # We send and receive json objects (dictionaries) encoded as strings
+    #  obj can also be bytes that are already msgpack-encoded
     def sendobj(self, obj):
         if not self.ws:
             return
 
         try:
-            b = msgpack.packb(obj)
-            self.ws.send(b, binary=True)
+            b = obj if isinstance(obj, bytes) else msgpack.packb(obj)
+            self.stats["msgs"] += 1
+            if self.options.get("batch"):
+                self._queue(b)
+            else:
+                self._send_frame(b)
         except WebSocketError:
             pass
         except Exception:
@@ -2242,6 +4272,102 @@ class BinaryWebsocketClient(object):
 
         return True
 
+    def _queue(self, b):
+        self.batch.append(b)
+        self.batch_bytes += len(b)
+        if self.batch_bytes >= WS_BATCH_BYTES:
+            self.flush()
+        elif not self.batch_flusher:
+            self.batch_flusher = gevent.spawn_later(
+                WS_BATCH_INTERVAL,
+                self._flush
+            )
+
+    def _flush(self):
+        self.batch_flusher = None
+        try:
+            self.flush()
+        except WebSocketError:
+            pass
+        except Exception:
+            log.exception("%s error sending batch", self)
+            self.close()
+
+    def flush(self):
+        # send batched messages as one frame
+        if not self.batch:
+            return
+        batch, self.batch, self.batch_bytes = self.batch, [], 0
+        if len(batch) == 1:
+            self._send_frame(batch[0])
+        else:
+            self._send_frame(codecs.msgpack_array(batch))
+
+    def _send_frame(self, b):
+        # The lock keeps frames in order while we compress one
+        with self.send_lock:
+            if self.options.get("deflate"):
+                if len(b) >= WS_DEFLATE_MIN_BYTES:
+                    b = b"\x01" + cpu_pool.run(zlib.compress, b)
+                else:
+                    b = b"\x00" + b
+            self.ws.send(b, binary=True)
+        self.stats["frames"] += 1
+        self.stats["bytes"] += len(b)
+        if self.credit is not None:
+            self.credit -= len(b)
+
+    def set_options(self, options):
+        # Use the framing options the client asked for that we support.
+        #  We acknowledge them with the old framing, and everything
+        #  after that uses the new one.
+        accepted = {
+            k: bool(v) for k, v in options.items() if k in self.FEATURES
+        }
+        try:
+            self.flush()
+            self._send_frame(msgpack.packb(dict(options=accepted)))
+        except WebSocketError:
+            return
+        except Exception:
+            log.exception("%s error setting options", self)
+            return
+        self.options = accepted
+
+        credit = options.get("credit")
+        if credit:
+            self.credit = int(credit)
+            self.credit_ready.set()
+        else:
+            self.credit = None
+
+    def add_credit(self, n):
+        if self.credit is None:
+            return
+        self.credit += int(n)
+        if self.credit > 0:
+            self.credit_ready.set()
+
+    def _wait_for_credit(self):
+        # Wait until the client has granted us credit to send more.
+        #  Returns False if it doesn't in time.
+        if (self.credit is None) or (self.credit > 0):
+            return True
+
+        # make sure the client has everything we have sent, so that
+        #  it can grant us more
+        self._flush()
+        self.stats["stalls"] += 1
+        timer = Timer()
+        while self.credit <= 0:
+            self.credit_ready.clear()
+            if self.closed or timer.elapsed() > WS_CREDIT_TIMEOUT:
+                log.info("%s timed out waiting for credit", self)
+                return False
+            self.credit_ready.wait(1)
+        self.stats["stalled"] += timer.elapsed()
+        return True
+
     def receiveobj(self):
         try:
             s = self.ws.receive()
@@ -2258,7 +4384,7 @@ class BinaryWebsocketClient(object):
     def close(self):
         opensecs = int(time.time() - self.birthday)
         elapsed = timedelta(seconds=opensecs)
-        log.debug("%s CLOSED. elapsed=%s", self.key, elapsed)
+        log.debug("%s CLOSED. elapsed=%s, %s", self.key, elapsed, self.stats)
 
         try:
             self.ws.close()
@@ -2267,17 +4393,28 @@ class BinaryWebsocketClient(object):
         self.gpool.kill()
 
     def send_key(self):
-        self.sendobj(dict(wskey=self.key))
+        self.sendobj(dict(wskey=self.key, features=self.FEATURES))
 
     def send_from(self, gen):
         # send everything from gen, a generator of dict objects.
         watchdog = self.gpool.spawn(self._watchdog, gen)
 
         for obj in gen:
+            # With flow control, we stop pulling from gen (so whatever
+            #  produces it waits too) until the client grants credit
             if self.closed:
                 break
+            if not self._wait_for_credit():
+                try:
+                    gen.send(True)
+                except Exception:
+                    pass
+                self.close()
+                break
             self.sendobj(obj)
-        
+
+        if not self.closed:
+            self._flush()
         watchdog.kill()
 
     def _pinger(self, delay=25):
@@ -2305,6 +4442,8 @@ class BinaryWebsocketClient(object):
             msg = self.receiveobj()
             if not msg:
                 continue
+            if "credit" in msg:
+                self.add_credit(msg["credit"])
             if "close" in msg:
                 abort_signal = True
                 log.info("%s watchdog: abort signal", self)
@@ -0,0 +1,164 @@
+# Running CPU-bound work (stream encoding, tile rendering) off the
+#  gevent event loop.
+#
+#  Everything in a gevent worker runs on one native thread, so a greenlet
+#  that spends 50ms encoding streams holds up every other greenlet
+#  (websocket pings, other users' requests) for 50ms.  CPUPool runs such
+#  work on a small pool of native threads instead.  zlib and most NumPy
+#  array operations release the GIL while they work, and pure Python
+#  code gives it up every few milliseconds (sys.getswitchinterval), so
+#  the event loop keeps running.  The json and msgpack C extensions do
+#  NOT release the GIL: a single large json.loads or msgpack.packb call
+#  blocks the loop just the same whichever thread runs it, so there is
+#  no point in handing those over on their own.
+#
+#  Functions given to CPUPool run in another thread, so they must not do
+#  I/O, logging, or anything else that involves gevent.
+#
+#  Like codecs.py, this module has no dependency on the Flask app.
+
+import os
+import time
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+from gevent.threadpool import ThreadPool
+
+
+def _call_all(calls):
+    # Runs in a pool thread: call each (fn, args) and return their
+    #  (ok, result-or-exception) along with the time it took
+    start = time.perf_counter()
+    results = []
+    for fn, args in calls:
+        try:
+            results.append((True, fn(*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results, time.perf_counter() - start
+
+
+class CPUPool(object):
+    # submit(fn, *args) returns a gevent AsyncResult for fn(*args), which
+    #  is run in one of threads native threads.  Calls submitted while
+    #  all of the threads are busy are handed over together, up to
+    #  batch_size at a time, which saves a thread hand-off (and event
+    #  loop wake-up) for each one.  With threads=0 calls run inline.
+
+    def __init__(self, threads=2, batch_size=16):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.pid = None
+        self.stats = dict(calls=0, inline=0, batches=0, errors=0, busy=0)
+
+    def _start(self):
+        # Threads don't survive a fork, so we start (or restart) the pool
+        #  in the process that uses it.
+        self.pid = os.getpid()
+        self.pool = ThreadPool(self.threads)
+        self.queue = gevent.queue.Queue()
+        self.slots = gevent.lock.BoundedSemaphore(self.threads)
+        self.dispatcher = gevent.spawn(self._dispatch)
+
+    def _dispatch(self):
+        while True:
+            self.slots.acquire()
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except gevent.queue.Empty:
+                    break
+            gevent.spawn(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        calls = [(fn, args) for fn, args, result in batch]
+        try:
+            results, busy = self.pool.apply(_call_all, (calls,))
+        except Exception as e:
+            results, busy = [(False, e)] * len(batch), 0
+        finally:
+            self.slots.release()
+
+        self.stats["batches"] += 1
+        self.stats["busy"] += busy
+        for (fn, args, result), (ok, value) in zip(batch, results):
+            if ok:
+                result.set(value)
+            else:
+                self.stats["errors"] += 1
+                result.set_exception(value)
+
+    def submit(self, fn, *args):
+        self.stats["calls"] += 1
+        result = gevent.event.AsyncResult()
+
+        if not self.threads:
+            self.stats["inline"] += 1
+            try:
+                result.set(fn(*args))
+            except Exception as e:
+                self.stats["errors"] += 1
+                result.set_exception(e)
+            return result
+
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put((fn, args, result))
+        return result
+
+    def run(self, fn, *args):
+        # fn(*args), computed in a pool thread
+        return self.submit(fn, *args).get()
+
+    def info(self):
+        info = dict(self.stats, threads=self.threads)
+        if self.stats["batches"]:
+            pooled = self.stats["calls"] - self.stats["inline"]
+            info["batch_mean"] = round(pooled / self.stats["batches"], 2)
+        if self.pid == os.getpid():
+            info["queued"] = self.queue.qsize()
+        info["busy"] = round(info["busy"], 3)
+        return info
+
+
+class LoopMonitor(object):
+    # Measures how long the event loop is blocked, by checking how late
+    #  a greenlet that sleeps for interval seconds wakes up.  Wake-ups
+    #  more than threshold seconds late count as blocks.
+
+    def __init__(self, interval=0.1, threshold=0.05):
+        self.interval = interval
+        self.threshold = threshold
+        self.pid = None
+        self.reset()
+
+    def reset(self):
+        self.stats = dict(samples=0, blocks=0, blocked=0, max_lag=0)
+
+    def start(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            gevent.sleep(self.interval)
+            lag = time.perf_counter() - start - self.interval
+            self.stats["samples"] += 1
+            if lag > self.threshold:
+                self.stats["blocks"] += 1
+                self.stats["blocked"] += lag
+            if lag > self.stats["max_lag"]:
+                self.stats["max_lag"] = lag
+
+    def info(self, reset=False):
+        info = dict(self.stats)
+        info["blocked"] = round(info["blocked"], 3)
+        info["max_lag"] = round(info["max_lag"], 3)
+        if reset:
+            self.reset()
+        return info
@@ -12,6 +12,7 @@ from urllib.parse import urlparse, urlunparse
 
 # Third party imports
 import base36
+import gevent
 import requests
 import stravalib
 from flask import current_app as app
@@ -26,7 +27,8 @@ from . import login_manager, redis, mongo, sockets
 
 from .models import (
     Users, Activities, EventLogger, Utility, Webhooks, Index,
-    Payments, BinaryWebsocketClient, StravaClient, Timer
+    Payments, BinaryWebsocketClient, StravaClient, Timer, Tiles, UserStats,
+    QueryCursors, cpu_pool, loop_monitor
 )
 
 mongodb = mongo.db
@@ -390,6 +392,15 @@ def main(username):
     if query.get("ids"):
         query["ids"] = re.split(';|,| ', query["ids"])
 
+    if query.get("bbox"):
+        # bbox=south,west,north,east
+        try:
+            s, w, n, e = (float(x) for x in query["bbox"].split(","))
+        except ValueError:
+            query["bbox"] = None
+        else:
+            query["bbox"] = [[s, w], [n, e]]
+
     if not any(query[x] for x in ["date1", "date2", "ids", "preset", "limit"]):
         # This is the default if nothing is specified
         query["limit"] = 10
@@ -447,6 +458,30 @@ def activity(username, _id):
     return jsonify(raw)
 
 
+@app.route('/tiles/<username>/<int:z>/<int:x>/<int:y>.png')
+def tile(username, z, x, y):
+    # Heatmap tile of a user's activities.  Anyone can see tiles
+    #  for users who share their profile.
+    user = Users.get(username)
+    if not user:
+        return "", 404
+
+    if not user.share_profile:
+        if current_user.is_anonymous:
+            return login_manager.unauthorized()
+        if not (current_user.is_admin() or current_user.id == user.id):
+            return login_manager.unauthorized()
+
+    n = 2 ** z
+    if not (0 <= z <= 20 and 0 <= x < n and 0 <= y < n):
+        return "", 404
+
+    png = Tiles.get(user, z, x, y)
+    response = Response(png, mimetype="image/png")
+    response.headers["Cache-Control"] = "private, max-age=300"
+    return response
+
+
 @app.route('/<username>/update_info')
 @log_request_event
 @admin_or_self_required
@@ -474,6 +509,12 @@ def data_socket(ws):
         if not obj:
             continue
        
+        if "options" in obj:
+            wsclient.set_options(obj.pop("options"))
+
+        if "credit" in obj:
+            wsclient.add_credit(obj.pop("credit"))
+
         if "close" in obj:
             break
 
@@ -484,8 +525,23 @@ def data_socket(ws):
 
             if "client_id" in query:
                 wsclient.client_id = query.pop("client_id")
+
+            # A client that lost its connection during a query can
+            #  pick up where it left off (see QueryCursors)
+            cursor_id = None
+            resume = obj.get("resume")
+            if resume:
+                remaining = QueryCursors.resume(
+                    resume.get("cursor"),
+                    resume.get("have")
+                )
+                if remaining is not None:
+                    query, cursor_id = remaining, resume["cursor"]
+
+            if obj.get("resumable") and not cursor_id:
+                cursor_id = QueryCursors.create(query)
             
-            query_result = Activities.query(query)
+            query_result = Activities.query(query, cursor_id=cursor_id)
             wsclient.send_from(query_result)
 
         elif "admin" in obj:
@@ -493,7 +549,10 @@ def data_socket(ws):
             if "events" in admin_request:
                 ts = admin_request.get("events") or time.time()
                 start = datetime.utcfromtimestamp(ts)
-                event_stream = EventLogger.live_updates_gen(start)
+                event_stream = EventLogger.live_updates_gen(
+                    start,
+                    closed=lambda: wsclient.closed
+                )
                 wsclient.send_from(event_stream)
         else:
             log.debug("%s received object %s", wsclient, obj)
@@ -660,6 +719,8 @@ def users_update():
 def user_profile(username):
     user = Users.get(username)
     output = user.info() if user else {}
+    if user:
+        output["stats"] = UserStats.get(user.id)
     return jsonify(output)
 
 
@@ -672,6 +733,20 @@ def app_info():
         "mongodb": mongodb.command("dbstats"),
         Activities.name: mongodb.command("collstats", Activities.name),
         Index.name: mongodb.command("collstats", Index.name),
+        "memory_cache": Activities.memory_cache.info(),
+        "activities_hub": Activities.hub.info(),
+        "ttl_touch": {
+            Index.name: Index.toucher.info(),
+            Activities.name: Activities.toucher.info()
+        },
+        "strava_pool": StravaClient.pool_info(),
+        "strava_rate_limiter": StravaClient.limiter.info(),
+        "cpu_pool": cpu_pool.info(),
+        "event_hub": EventLogger.hub.info(),
+        "event_log": EventLogger.info(),
+        "event_loop": loop_monitor.info(
+            reset=request.args.get("reset_loop_stats")
+        ),
         "config": app.config
     }
     return jsonify(info)
@@ -689,6 +764,21 @@ def app_init():
     return "Activities, Index initialized and redis cleared\n{}".format(info)
 
 
+@app.route('/app/migrate_streams')
+@admin_required
+def app_migrate_streams():
+    # This can take a while so we do it in the background
+    gevent.spawn(Activities.migrate_streams)
+    return "Activity stream migration started. See event log for result."
+
+
+@app.route('/app/backfill_box')
+@admin_required
+def app_backfill_box():
+    gevent.spawn(Index.backfill_box)
+    return "Index box backfill started. See event log for result."
+
+
 @app.route("/beacon_handler", methods=["POST"])
 def beacon_handler():
     key = str(request.data, "utf-8")
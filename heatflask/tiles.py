@@ -0,0 +1,127 @@
+# Heatmap tile rendering with NumPy.
+#
+#  Tiles use the usual web map (Web Mercator, "slippy map") scheme:
+#  at zoom z the world is 2^z by 2^z tiles of TILE_SIZE pixels,
+#  numbered from the top left.  Like codecs.py, this module has no
+#  dependency on the Flask app.
+
+import zlib
+import struct
+
+import numpy as np
+
+TILE_SIZE = 256
+
+# Segments longer than this (in pixels) are drawn with no more than this
+#  many dots.  They are usually GPS dropouts anyway.
+MAX_SEGMENT_SAMPLES = 4 * TILE_SIZE
+
+
+def _lat_to_y(lat):
+    # Mercator y in [0, 1] (top to bottom) for latitudes in degrees
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    return (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+
+
+def _y_to_lat(y):
+    return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y)))))
+
+
+def tile_bounds(z, x, y):
+    #  ((south, west), (north, east)) of tile x, y at zoom z
+    n = 2.0 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = _y_to_lat(y / n)
+    south = _y_to_lat((y + 1) / n)
+    return (south, west), (north, east)
+
+
+def to_pixels(latlng, z, x, y, size=TILE_SIZE):
+    #  Pixel coordinates (column, row) within tile x, y of an (n, 2)
+    #  array of (lat, lng) points
+    latlng = np.asarray(latlng, dtype=np.float64).reshape(-1, 2)
+    scale = (2 ** z) * size
+    col = (latlng[:, 1] + 180) / 360 * scale - x * size
+    row = _lat_to_y(latlng[:, 0]) * scale - y * size
+    return np.column_stack((col, row))
+
+
+def _trace(px, size):
+    #  Points along each segment of a track (given in pixels), about one
+    #  per pixel, for the segments that come near the tile
+    a, b = px[:-1], px[1:]
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    near = ((hi >= 0) & (lo < size)).all(axis=1)
+    if not near.any():
+        return np.empty((0, 2))
+
+    a, d = a[near], (b - a)[near]
+    steps = np.ceil(np.abs(d).max(axis=1)).astype(np.int64)
+    steps = np.clip(steps, 1, MAX_SEGMENT_SAMPLES)
+
+    seg = np.repeat(np.arange(len(steps)), steps)
+    first = np.cumsum(steps) - steps
+    t = (np.arange(len(seg)) - first[seg]) / steps[seg]
+    return a[seg] + t[:, None] * d[seg]
+
+
+def density(tracks, z, x, y, size=TILE_SIZE):
+    #  A (size, size) array counting how many track points fall in
+    #  each pixel of the tile, for an iterable of (n, 2) (lat, lng) arrays
+    counts = np.zeros(size * size, dtype=np.int64)
+    for latlng in tracks:
+        if len(latlng) < 2:
+            continue
+        pts = np.floor(_trace(to_pixels(latlng, z, x, y, size), size))
+        pts = pts.astype(np.int64)
+        inside = ((pts >= 0) & (pts < size)).all(axis=1)
+        pts = pts[inside]
+        counts += np.bincount(
+            pts[:, 1] * size + pts[:, 0], minlength=size * size
+        )
+    return counts.reshape(size, size)
+
+
+def colorize(counts):
+    #  RGBA (uint8) heatmap of counts, on a log scale: dark red for the
+    #  least-travelled pixels through yellow to white for the most.
+    #  Empty pixels are transparent.
+    v = np.log1p(counts)
+    top = v.max()
+    if top:
+        v /= top
+    rgba = np.empty(counts.shape + (4,), dtype=np.float64)
+    rgba[..., 0] = np.clip(3 * v + 0.3, 0, 1)
+    rgba[..., 1] = np.clip(3 * v - 1, 0, 1)
+    rgba[..., 2] = np.clip(3 * v - 2, 0, 1)
+    rgba[..., 3] = np.where(counts > 0, np.clip(0.5 + v, 0, 1), 0)
+    return (rgba * 255).astype(np.uint8)
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return (
+        struct.pack(">I", len(data)) + chunk +
+        struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+    )
+
+
+def png_encode(rgba):
+    #  Encode an (h, w, 4) uint8 array as a PNG image
+    h, w = rgba.shape[:2]
+    # each row starts with a filter type byte (0 = none)
+    raw = np.zeros((h, w * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(h, w * 4)
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 6, 0, 0, 0)),
+        _png_chunk(b"IDAT", zlib.compress(raw.tobytes())),
+        _png_chunk(b"IEND", b""),
+    ])
+
+
+def render_tile(tracks, z, x, y, size=TILE_SIZE):
+    #  PNG heatmap tile for an iterable of (n, 2) (lat, lng) arrays
+    return png_encode(colorize(density(tracks, z, x, y, size)))
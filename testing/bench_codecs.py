@@ -0,0 +1,207 @@
+#  Benchmark the NumPy stream codecs in heatflask.codecs against the
+#  pure-Python implementations they replaced (our old RLE code and the
+#  polyline package), show what the LOD levels cost and save, and
+#  compare the stored size of the old and new stream formats.
+#
+#  usage:  python -m testing.bench_codecs [repeats]
+
+import sys
+import random
+import timeit
+
+import msgpack
+import polyline
+
+from testing.standalone import load
+
+codecs = load("codecs")
+
+
+# --------- Reference (pure-Python) implementations ----------------
+def py_rle_encode(vals):
+    diffs = [b - a for a, b in zip(vals, vals[1:])]
+    encoded = []
+    pair = None
+    for a, b in zip(diffs, diffs[1:]):
+        if a == b:
+            if pair:
+                pair[1] += 1
+            else:
+                pair = [a, 2]
+        else:
+            if pair:
+                if pair[1] > 2:
+                    encoded.append(pair)
+                else:
+                    encoded.extend(2 * [pair[0]])
+                pair = None
+            else:
+                encoded.append(a)
+    if pair:
+        encoded.append(pair)
+    else:
+        encoded.append(b)
+    return encoded
+
+
+def py_rle_decode(rll_encoded, first_value=0):
+    running_sum = first_value
+    out_list = [first_value]
+
+    for el in rll_encoded:
+        if isinstance(el, list) and len(el) == 2:
+            val, num_repeats = el
+            for i in range(num_repeats):
+                running_sum += val
+                out_list.append(running_sum)
+        else:
+            running_sum += el
+            out_list.append(running_sum)
+
+    return out_list
+
+
+# --------- Test data ----------------------------------------------
+def time_stream(n, seed=0):
+    # A typical Strava time stream: mostly 1-second steps with
+    #  occasional pauses and gaps
+    rnd = random.Random(seed)
+    t = [0]
+    for i in range(n - 1):
+        r = rnd.random()
+        if r < 0.9:
+            step = 1
+        elif r < 0.98:
+            step = rnd.randint(2, 5)
+        else:
+            step = rnd.randint(6, 600)
+        t.append(t[-1] + step)
+    return t
+
+
+def latlng_stream(n, seed=0):
+    rnd = random.Random(seed)
+    lat, lng = 45.5, -122.6
+    latlngs = []
+    for i in range(n):
+        lat += rnd.uniform(-5e-5, 5e-5)
+        lng += rnd.uniform(-5e-5, 5e-5)
+        latlngs.append([lat, lng])
+    return latlngs
+
+
+def py_bounds(poly):
+    latlngs = polyline.decode(poly)
+    lats = [ll[0] for ll in latlngs]
+    lngs = [ll[1] for ll in latlngs]
+    return {
+        "SW": (min(lats), min(lngs)),
+        "NE": (max(lats), max(lngs))
+    }
+
+
+def timed(fn, repeats):
+    return 1000 * min(timeit.repeat(fn, number=1, repeat=repeats))
+
+
+def bench_polyline(n, repeats):
+    latlngs = latlng_stream(n)
+    poly = polyline.encode(latlngs)
+
+    assert codecs.polyline_encode(latlngs) == (poly, py_bounds(poly))
+    assert codecs.polyline_bounds(poly) == py_bounds(poly)
+
+    return {
+        "py_encode": timed(lambda: polyline.encode(latlngs), repeats),
+        "np_encode": timed(lambda: codecs.polyline_encode(latlngs), repeats),
+        "py_decode": timed(lambda: py_bounds(poly), repeats),
+        "np_decode": timed(lambda: codecs.polyline_bounds(poly), repeats),
+    }
+
+
+def bench(n, repeats):
+    t = time_stream(n)
+    encoded = py_rle_encode(t)
+
+    # the encodings must be byte-identical once packed
+    assert msgpack.packb(codecs.rle_encode(t)) == msgpack.packb(encoded)
+    assert codecs.rle_decode(encoded).tolist() == py_rle_decode(encoded)
+
+    return {
+        "py_encode": timed(lambda: py_rle_encode(t), repeats),
+        "np_encode": timed(lambda: codecs.rle_encode(t), repeats),
+        "py_decode": timed(lambda: py_rle_decode(encoded), repeats),
+        "np_decode": timed(lambda: codecs.rle_decode(encoded), repeats),
+    }
+
+
+def report(title, bench_fn, repeats):
+    print(title)
+    print("{:>8} {:>10} {:>10} {:>7} {:>10} {:>10} {:>7}".format(
+        "n", "py_enc ms", "np_enc ms", "x", "py_dec ms", "np_dec ms", "x"))
+
+    for n in [10000, 25000, 50000, 100000]:
+        r = bench_fn(n, repeats)
+        print("{:>8} {:>10.2f} {:>10.2f} {:>7.1f} {:>10.2f} {:>10.2f} {:>7.1f}".format(
+            n,
+            r["py_encode"], r["np_encode"], r["py_encode"] / r["np_encode"],
+            r["py_decode"], r["np_decode"], r["py_decode"] / r["np_decode"],
+        ))
+
+
+def report_lod(repeats):
+    # wire size of each LOD level vs. full resolution, and how long it
+    #  takes to compute the levels at import
+    print("LOD levels (wire bytes)")
+    columns = ["z<={}".format(z) for z, tol in codecs.LODS] + ["full"]
+    print("{:>8} {:>10} {}".format(
+        "n", "lods ms", "  ".join("{:>8}".format(c) for c in columns)))
+
+    for n in [10000, 25000, 50000, 100000]:
+        latlngs = latlng_stream(n)
+        packed = codecs.pack_streams(latlngs, time=time_stream(n))
+        sizes = [
+            len(msgpack.packb(codecs.streams_to_wire(packed, lod=lod)))
+            for lod in list(range(len(codecs.LODS))) + [None]
+        ]
+        ints = codecs.unpack_streams(packed)["latlng"]
+        dt = timed(lambda: codecs.lod_indices(ints, 10 ** 5), repeats)
+        print("{:>8} {:>10.2f} {}".format(
+            n, dt, "  ".join("{:>8}".format(size) for size in sizes)))
+
+
+def report_storage(repeats):
+    # stored size of the old (version 1) msgpack format and of version 2
+    #  containers, and what it costs to get wire format streams from each
+    print("storage (bytes, ms to wire format)")
+    print("{:>8} {:>8} {:>8} {:>8} {:>6} {:>9} {:>9} {:>9}".format(
+        "n", "v1", "v2 zlib", "v2 raw", "ratio",
+        "v1 ms", "zlib ms", "raw ms"))
+
+    for n in [10000, 25000, 50000, 100000]:
+        latlngs, t = latlng_stream(n), time_stream(n)
+        wire = msgpack.packb(dict(
+            polyline=codecs.polyline_encode(latlngs)[0],
+            n=n,
+            time=codecs.rle_encode(t)
+        ))
+        z = codecs.pack_streams(latlngs, time=t)
+        raw = codecs.pack_streams(latlngs, compress=False, time=t)
+
+        def to_wire(packed):
+            return lambda: msgpack.packb(codecs.streams_to_wire(packed))
+
+        print("{:>8} {:>8} {:>8} {:>8} {:>6.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            n, len(wire), len(z), len(raw), len(wire) / len(z),
+            timed(lambda: msgpack.unpackb(wire), repeats),
+            timed(to_wire(z), repeats),
+            timed(to_wire(raw), repeats)
+        ))
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    report("time stream RLE", bench, repeats)
+    report("polyline (decode = bounds)", bench_polyline, repeats)
+    report_lod(min(repeats, 5))
+    report_storage(repeats)
@@ -0,0 +1,74 @@
+#  Compare activity stream import throughput with a fresh connection
+#  per request (bare requests.get) against a shared keep-alive
+#  connection pool (what StravaClient uses), against the stub Strava
+#  server in testing/strava_stub.py.
+#
+#  usage:
+#     python -m testing.strava_stub &
+#     python -m testing.bench_import [--url http://localhost:5050]
+#                                    [-n 1000] [--concurrency 64]
+
+from gevent import monkey
+monkey.patch_all()
+
+import time
+import argparse
+
+import gevent.pool
+import requests
+from requests.adapters import HTTPAdapter
+
+STREAMS_PATH = (
+    "/api/v3/activities/{id}/streams"
+    "?keys=latlng,time&key_by_type=true&series_type=time&resolution=high"
+)
+FIRST_ACTIVITY_ID = 1000000
+
+
+def stub_stats(base_url):
+    return requests.get(base_url + "/stats").json()
+
+
+def run(base_url, n, concurrency, get):
+    before = stub_stats(base_url)
+    ids = range(FIRST_ACTIVITY_ID, FIRST_ACTIVITY_ID + n)
+
+    def fetch(_id):
+        response = get(base_url + STREAMS_PATH.format(id=_id))
+        response.raise_for_status()
+        return len(response.json()["latlng"]["data"])
+
+    pool = gevent.pool.Pool(concurrency)
+    start = time.time()
+    points = sum(pool.imap_unordered(fetch, ids))
+    elapsed = time.time() - start
+
+    after = stub_stats(base_url)
+    return dict(
+        dt=round(elapsed, 2),
+        rate=round(n / elapsed, 1),
+        points=points,
+        connections=after["connections"] - before["connections"]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5050")
+    parser.add_argument("-n", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    print("bare requests.get:", run(
+        args.url, args.n, args.concurrency,
+        lambda url: requests.get(url)
+    ))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    print("shared session:   ", run(
+        args.url, args.n, args.concurrency, session.get
+    ))
@@ -0,0 +1,85 @@
+#  Show how much stream encoding blocks the gevent event loop, with it
+#  done inline and on a CPUPool (see heatflask.offload).  A burst of
+#  concurrent imports encodes streams like Activities.encode_streams
+#  while a LoopMonitor checks how late the event loop wakes up.
+#
+#  usage:  python -m testing.bench_offload [concurrency] [points]
+
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import math
+import json
+import random
+import time
+
+import gevent
+import msgpack
+
+from testing.standalone import load
+
+codecs = load("codecs")
+offload = load("offload")
+
+
+def make_streams(n, seed):
+    rnd = random.Random(seed)
+    lat, lng = 38.5, -120.2
+    latlng = []
+    for i in range(n):
+        lat += 1e-4 * math.sin(i / 50.0) + rnd.uniform(-2e-5, 2e-5)
+        lng += 1e-4 * math.cos(i / 50.0) + rnd.uniform(-2e-5, 2e-5)
+        latlng.append([round(lat, 6), round(lng, 6)])
+    t = list(range(n))
+    return json.dumps({"latlng": {"data": latlng}, "time": {"data": t}})
+
+
+def encode(body):
+    # what we do with a streams response from Strava
+    d = json.loads(body)
+    latlngs, t = d["latlng"]["data"], d["time"]["data"]
+    encoded = {}
+    encoded["polyline"], bounds = codecs.polyline_encode(latlngs)
+    encoded["time"] = codecs.rle_encode(t)
+    encoded["n"] = len(latlngs)
+    packed = codecs.pack_streams(latlngs, time=t)
+    return packed, msgpack.packb(encoded)
+
+
+def run(bodies, threads):
+    pool = offload.CPUPool(threads)
+    monitor = offload.LoopMonitor(interval=0.005, threshold=0.02)
+    monitor.start()
+    gevent.sleep(0.05)
+    monitor.reset()
+
+    start = time.perf_counter()
+    jobs = [gevent.spawn(pool.run, encode, body) for body in bodies]
+    gevent.joinall(jobs, raise_error=True)
+    elapsed = time.perf_counter() - start
+
+    gevent.sleep(0.05)
+    monitor.greenlet.kill()
+    return elapsed, monitor.info(), pool.info()
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    points = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    bodies = [make_streams(points, i) for i in range(concurrency)]
+
+    print("{} concurrent imports of {} points".format(concurrency, points))
+    for threads in (0, 1, 2, 4):
+        elapsed, loop, pool = run(bodies, threads)
+        print(
+            "threads={}: {:.3f}s  max_lag={}s  blocked={}s ({} blocks)  "
+            "batches={}".format(
+                threads, elapsed, loop["max_lag"], loop["blocked"],
+                loop["blocks"], pool["batches"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+#  Load the heatflask modules that don't depend on the Flask app
+#  (codecs.py, offload.py, tiles.py) straight from their files.
+#  Importing them as heatflask.codecs etc. would run
+#  heatflask/__init__.py, which sets up the whole app (and needs
+#  Flask and all of its extensions installed).
+#
+#  usage:  from testing.standalone import load
+#          codecs = load("codecs")
+
+import os
+import sys
+import importlib.util
+
+HEATFLASK_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "heatflask"
+)
+
+
+def load(name):
+    module_name = "heatflask_" + name
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    path = os.path.join(HEATFLASK_DIR, name + ".py")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,151 @@
+#  A stand-in for the parts of the Strava API that we use, for
+#  benchmarking activity import without hitting Strava.
+#
+#  usage:
+#     python -m testing.strava_stub [--port 5050] [--activities 2000]
+#                                   [--latency 0.05] [--connect-delay 0.1]
+#
+#  then run heatflask with STRAVA_API_URL=http://localhost:5050/api/v3
+#
+#  --latency is added to every response.  --connect-delay is added to
+#  the first response on each new connection, to simulate the cost of
+#  a TCP+TLS handshake with the real thing.
+
+from gevent import monkey
+monkey.patch_all()
+
+import re
+import sys
+import json
+import time
+import math
+import random
+import argparse
+from urllib.parse import parse_qs
+
+import gevent
+from gevent import pywsgi
+
+STATS = dict(requests=0, connections=0)
+SEEN_CONNECTIONS = set()
+
+ACTIVITIES_RE = re.compile(r"/api/v3/athlete/activities$")
+ACTIVITY_RE = re.compile(r"/api/v3/activities/(\d+)$")
+STREAMS_RE = re.compile(r"/api/v3/activities/(\d+)/streams$")
+
+ATHLETE_ID = 1
+FIRST_ACTIVITY_ID = 1000000
+EPOCH_START = 1262304000  # 2010-01-01
+SPACING = 86400 // 2
+
+SUMMARY_POLYLINE = "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+
+
+def summary(_id):
+    i = _id - FIRST_ACTIVITY_ID
+    start = EPOCH_START + i * SPACING
+    ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start))
+    return {
+        "id": _id,
+        "athlete": {"id": ATHLETE_ID},
+        "name": "Activity {}".format(i),
+        "type": random.Random(_id).choice(["Run", "Ride", "Walk"]),
+        "start_date": ts,
+        "start_date_local": ts,
+        "distance": 10000.0,
+        "elapsed_time": 3600,
+        "average_speed": 2.78,
+        "start_latlng": [38.5, -120.2],
+        "map": {"summary_polyline": SUMMARY_POLYLINE},
+    }
+
+
+def streams(_id, n):
+    rnd = random.Random(_id)
+    lat, lng = 38.5, -120.2
+    latlng, t = [], []
+    for i in range(n):
+        lat += 1e-4 * math.sin(i / 50.0) + rnd.uniform(-2e-5, 2e-5)
+        lng += 1e-4 * math.cos(i / 50.0) + rnd.uniform(-2e-5, 2e-5)
+        latlng.append([round(lat, 6), round(lng, 6)])
+        t.append(i)
+    return {
+        "latlng": {"data": latlng},
+        "time": {"data": t},
+    }
+
+
+def make_app(args):
+    ids = list(range(FIRST_ACTIVITY_ID, FIRST_ACTIVITY_ID + args.activities))
+    ids.reverse()  # most recent first, like Strava
+
+    def respond(start_response, obj, status="200 OK"):
+        body = json.dumps(obj).encode("utf-8")
+        start_response(status, [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("X-RateLimit-Limit", "600,30000"),
+            ("X-RateLimit-Usage", "0,0"),
+        ])
+        return [body]
+
+    def app(environ, start_response):
+        path = environ["PATH_INFO"]
+        if path == "/stats":
+            return respond(start_response, STATS)
+
+        STATS["requests"] += 1
+        conn = (environ.get("REMOTE_ADDR"), environ.get("REMOTE_PORT"))
+        delay = args.latency
+        if conn not in SEEN_CONNECTIONS:
+            SEEN_CONNECTIONS.add(conn)
+            STATS["connections"] += 1
+            delay += args.connect_delay
+        gevent.sleep(delay)
+
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+
+        if ACTIVITIES_RE.match(path):
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            start = (page - 1) * per_page
+            page_ids = ids[start:start + per_page]
+            return respond(start_response, [summary(i) for i in page_ids])
+
+        m = STREAMS_RE.match(path)
+        if m:
+            return respond(
+                start_response,
+                streams(int(m.group(1)), args.points)
+            )
+
+        m = ACTIVITY_RE.match(path)
+        if m:
+            return respond(start_response, summary(int(m.group(1))))
+
+        return respond(
+            start_response, {"message": "Record Not Found"}, "404 Not Found"
+        )
+
+    return app
+
+
+def report_stats():
+    while True:
+        gevent.sleep(5)
+        sys.stderr.write("stub: {}\n".format(STATS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--activities", type=int, default=2000)
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--connect-delay", type=float, default=0.1)
+    args = parser.parse_args()
+
+    gevent.spawn(report_stats)
+    server = pywsgi.WSGIServer(("", args.port), make_app(args), log=None)
+    print("Strava stub serving on port {}".format(args.port))
+    server.serve_forever()